@@ -0,0 +1,348 @@
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import simul2
+from blocking_prob import erlang_b
+from event_lists import EVENT_LISTS
+
+
+# Fraction a measurement may get worse by before compare calls it a regression
+REGRESSION_THRESHOLD = 0.10
+
+# Blocking probability the CSC of a synthetic network is sized for
+SYNTHETIC_BLOCKING = 0.05
+
+# (name, number of PSCs or None for hospitals_demo.csv, duration in days)
+# every PSC adds to the arrivals at the CSC, so the bigger networks have higher rates as well
+SCENARIOS = [
+    ('demo', None, 2000),
+    ('psc10', 10, 500),
+    ('psc100', 100, 1000),
+    ('psc1000', 1000, 2000),
+]
+
+# Number of pending events the event lists are timed at, see event_list_benchmark
+EVENT_LIST_SIZES = [100, 1000, 10000, 100000, 1000000]
+
+# Measurements compare looks at, and whether bigger is better for them
+MEASUREMENTS = [
+    ('events_per_second', True),
+    ('setup_seconds', False),
+    ('post_processing_seconds', False),
+    ('peak_rss_mb', False),
+]
+
+
+def patient_objects(n, with_events = True):
+    '''
+    One Patient / NonStrokePatient object per patient
+    (the per-object representation the simulation used to keep)
+    '''
+    patients = []
+    events = []
+    for i in range(n):
+        if i % 2:
+            patient = simul2.Patient(i, float(i), True, "ISCHEMIC", 4.0, False)
+        else:
+            patient = simul2.NonStrokePatient(i, float(i), False, 3.3)
+        patients.append(patient)
+        if with_events:
+            events.append((patient.completion_time, i, simul2.DEPARTURE, 0, patient))
+    return patients, events
+
+
+def patient_table(n, with_events = True):
+    '''
+    One PatientTable row per patient, the events point at the row
+    '''
+    patients = simul2.PatientTable()
+    events = []
+    for i in range(n):
+        if i % 2:
+            patient = patients.add(float(i), 4.0, simul2.ISCHEMIC, simul2.STROKE_FLAG | simul2.FROM_PSC_FLAG)
+        else:
+            patient = patients.add(float(i), 3.3, simul2.NON_STROKE, 0)
+        if with_events:
+            events.append((patients.completion_time[patient], i, simul2.DEPARTURE, 0, patient))
+    return patients, events
+
+
+def bytes_per_patient(build, n, with_events):
+    '''
+    Memory held by n in-flight patients built by build, per patient
+    '''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(n, with_events)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / n
+
+
+def memory_benchmark(n):
+    '''
+    Bytes per in-flight patient, before (objects) and after (PatientTable),
+    for the patient alone and together with its pending event
+    '''
+    results = {}
+    for with_events in [False, True]:
+        key = 'with_event' if with_events else 'patient'
+        results[key] = {
+            'objects': bytes_per_patient(patient_objects, n, with_events),
+            'table': bytes_per_patient(patient_table, n, with_events),
+        }
+
+    print("---------------------------------------------------")
+    print("Bytes per in-flight patient ({} patients)".format(n))
+    print("---------------------------------------------------")
+    print("                  objects     table    reduction")
+    for key, label in [('patient', "patient only"), ('with_event', "with its event")]:
+        objects = results[key]['objects']
+        table = results[key]['table']
+        print("{0:16s} {1:8.1f}  {2:8.1f}  {3:8.1f}x".format(label, objects, table, objects / table))
+    print("---------------------------------------------------")
+
+    return results
+
+
+def hold_seconds(event_list, size, operations, seed = 0):
+    '''
+    Seconds per operation of the hold model on an event list holding size events:
+    take the first event off and put a new one on a random (exponential) time later
+    Half of the events are arrivals, as in a simulation with many hospitals
+    '''
+    rng = np.random.default_rng(seed)
+    times = rng.exponential(size, size).tolist()
+    codes = (rng.random(size + operations) < 0.5).astype(int) * simul2.DEPARTURE
+    codes = codes.tolist()
+    gaps = rng.exponential(size, operations).tolist()
+    queue = EVENT_LISTS[event_list]((times[i], i, codes[i], 0, i) for i in range(size))
+
+    push = queue.push
+    pop = queue.pop
+    start = time.perf_counter()
+    for i in range(size, size + operations):
+        event = pop()
+        push((event[0] + gaps[i - size], i, codes[i], 0, i))
+    return (time.perf_counter() - start) / operations
+
+
+def event_list_benchmark(sizes = None, operations = 200000):
+    '''
+    Time every event list backend on the hold model at every size, and print where
+    each one starts to beat the binary heap (the crossover)
+    Returns {backend: {size: nanoseconds per operation}}
+    '''
+    sizes = sizes or EVENT_LIST_SIZES
+    results = {name: {} for name in EVENT_LISTS}
+
+    print("---------------------------------------------------")
+    print("Event list hold model, nanoseconds per pop + push")
+    print("---------------------------------------------------")
+    print("{0:>10s}".format("events") + "".join("{0:>12s}".format(name) for name in EVENT_LISTS))
+    for size in sizes:
+        for name in EVENT_LISTS:
+            results[name][size] = 1e9 * hold_seconds(name, size, operations)
+        print("{0:10d}".format(size) + "".join("{0:12.0f}".format(results[name][size]) for name in EVENT_LISTS))
+    print("---------------------------------------------------")
+
+    for name in EVENT_LISTS:
+        if name == 'heap':
+            continue
+        faster = [size for size in sizes if results[name][size] < results['heap'][size]]
+        if faster:
+            print("{0}: faster than the heap from {1} events".format(name, faster[0]))
+        else:
+            print("{0}: slower than the heap up to {1} events".format(name, sizes[-1]))
+    print("---------------------------------------------------")
+
+    return results
+
+
+def synthetic_config(psc_count, duration):
+    '''
+    A demo-like network with psc_count PSCs feeding one CSC, the CSC is given
+    the fewest beds that keep Erlang-B blocking under SYNTHETIC_BLOCKING
+    '''
+    demo = simul2.read_config('hospitals_demo.csv')
+    csc = [hospital for hospital in demo.hospitals if hospital.kind == 'CSC'][0]
+    psc = [hospital for hospital in demo.hospitals if hospital.kind == 'PSC'][0]
+
+    hospitals = (csc._replace(pid = 0),) + tuple(psc._replace(pid = pid) for pid in range(1, psc_count + 1))
+    config = demo._replace(duration = duration, number_of_simulations = 1, hospitals = hospitals)
+
+    load = simul2.config_offered_load(config)
+    beds = int(np.ceil(load))
+    while erlang_b(beds, load) > SYNTHETIC_BLOCKING:
+        beds += 1
+    return simul2.sweep_config(config, 'max_beds', beds)
+
+
+def scenario_config(psc_count, duration):
+    if psc_count is None:
+        return simul2.read_config('hospitals_demo.csv')._replace(duration = duration)
+    return synthetic_config(psc_count, duration)
+
+
+def run_scenario(psc_count, duration, seed, instrument = False, event_list = 'heap'):
+    '''
+    One timed replication of a scenario, meant to run in a fresh process so that
+    the peak RSS belongs to this scenario alone
+    With instrument the run is profiled as well (which slows it down)
+    '''
+    config = scenario_config(psc_count, duration)
+
+    start = time.perf_counter()
+    simul2.apply_config(config)
+    hospital_dict = simul2.build_hospital_dict(simul2.build_hospitals(config.hospitals))
+    simulation = simul2.Simulation(0, hospital_dict, rng = np.random.default_rng(seed), instrument = instrument,
+                                   event_list = event_list)
+    setup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    simulation.run_simulation()
+    run = time.perf_counter() - start
+
+    start = time.perf_counter()
+    simul2.summary_statistics(simul2.replication_metrics(simulation))
+    post_processing = time.perf_counter() - start
+
+    result = {
+        'hospitals': len(hospital_dict),
+        'duration': duration,
+        'events': simulation.events_processed,
+        'events_per_second': simulation.events_processed / run,
+        'setup_seconds': setup,
+        'run_seconds': run,
+        'post_processing_seconds': post_processing,
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 if sys.platform != 'darwin' else 1024.0**2),
+    }
+    if instrument:
+        result['instrumentation'] = simulation.instrumentation.report()
+        result['instrumentation_text'] = simulation.instrumentation.text_report()
+    return result
+
+
+def suite(names = None, scale = 1.0, repeat = 1, seed = 0, instrument = False, event_list = 'heap'):
+    '''
+    Run the scenarios (all of SCENARIOS by default), each repeat times in a fresh process,
+    keeping the best time of every measurement and the largest peak RSS
+    Durations are multiplied by scale, to trade accuracy for a quicker run
+    '''
+    results = {}
+    for name, psc_count, duration in SCENARIOS:
+        if names and name not in names:
+            continue
+        runs = []
+        for r in range(repeat):
+            with ProcessPoolExecutor(max_workers = 1) as executor:
+                runs.append(executor.submit(run_scenario, psc_count, duration * scale, seed, instrument,
+                                            event_list).result())
+
+        best = dict(runs[0])
+        best['events_per_second'] = max(run['events_per_second'] for run in runs)
+        for measurement in ['setup_seconds', 'run_seconds', 'post_processing_seconds']:
+            best[measurement] = min(run[measurement] for run in runs)
+        best['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+        results[name] = best
+
+        print("{0:8s} {1:5d} hospitals {2:9d} events  {3:10.0f} events/s  setup {4:.3f}s  post {5:.4f}s  rss {6:.1f} MB".format(
+            name, best['hospitals'], best['events'], best['events_per_second'],
+            best['setup_seconds'], best['post_processing_seconds'], best['peak_rss_mb']))
+        if instrument:
+            print(best.pop('instrumentation_text'))
+
+    return {
+        'engine_version': simul2.ENGINE_VERSION,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'scale': scale,
+        'event_list': event_list,
+        'scenarios': results,
+    }
+
+
+def compare(results, baseline, threshold = REGRESSION_THRESHOLD):
+    '''
+    Print every measurement against the baseline and return the ones that
+    got worse by more than threshold, as (scenario, measurement, baseline, now)
+    '''
+    regressions = []
+    print("---------------------------------------------------")
+    print("Compared to the baseline (regression threshold {:.0f}%)".format(100 * threshold))
+    print("---------------------------------------------------")
+    for name, now in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            print("{0:8s} not in the baseline".format(name))
+            continue
+        for measurement, bigger_is_better in MEASUREMENTS:
+            change = now[measurement] / before[measurement] - 1 if before[measurement] else 0.0
+            worse = -change if bigger_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = "  <-- REGRESSION"
+                regressions.append((name, measurement, before[measurement], now[measurement]))
+            print("{0:8s} {1:24s} {2:12.4g} -> {3:12.4g} ({4:+6.1f}%){5}".format(
+                name, measurement, before[measurement], now[measurement], 100 * change, flag))
+    print("---------------------------------------------------")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmarks for the simulation engine")
+    parser.add_argument("--scenarios", nargs = "*",
+                        help = "scenarios to run, out of {}".format(", ".join(name for name, psc_count, duration in SCENARIOS)))
+    parser.add_argument("--scale", type = float, default = 1.0,
+                        help = "multiply every scenario duration by this")
+    parser.add_argument("--repeat", type = int, default = 1,
+                        help = "runs per scenario, the best one is kept")
+    parser.add_argument("--output", help = "write the results to this JSON file")
+    parser.add_argument("--compare", help = "JSON results of an earlier run to check for regressions against")
+    parser.add_argument("--threshold", type = float, default = REGRESSION_THRESHOLD,
+                        help = "fraction a measurement may get worse by before it is flagged")
+    parser.add_argument("--profile", action = "store_true",
+                        help = "instrument the runs and print where the time goes (slower, not for comparing)")
+    parser.add_argument("--memory", action = "store_true",
+                        help = "run the bytes per patient benchmark instead")
+    parser.add_argument("--patients", type = int, default = 100000,
+                        help = "number of in-flight patients for the memory benchmark")
+    parser.add_argument("--event-list", default = 'heap', choices = sorted(EVENT_LISTS),
+                        help = "event list backend the scenarios are run with")
+    parser.add_argument("--event-lists", action = "store_true",
+                        help = "time every event list backend on the hold model instead, to find the crossovers")
+    parser.add_argument("--sizes", type = int, nargs = "*",
+                        help = "event list sizes for --event-lists, default {}".format(EVENT_LIST_SIZES))
+    args = parser.parse_args()
+
+    if args.memory:
+        simul2.apply_config(simul2.read_config('hospitals_demo.csv'))
+        memory_benchmark(args.patients)
+        sys.exit(0)
+
+    if args.event_lists:
+        event_list_benchmark(args.sizes)
+        sys.exit(0)
+
+    results = suite(args.scenarios, args.scale, args.repeat, instrument = args.profile, event_list = args.event_list)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
@@ -16,27 +16,89 @@ stroke_processing_rate = 1.0 / ((0.15)*(7) + (0.85)*(4))
 non_stroke_processing_rate = 1.0 / (3.3)
 
 
-def calculate_blocking_prob(num_beds, transfer_rate, plot = False, filename = ''):
-
-    n = num_beds
+def offered_load(transfer_rate, stroke_psc = None, stroke_csc = None, non_stroke = None,
+                 stroke_rate = None, non_stroke_rate = None):
+    '''
+    Offered load (in beds) at the CSC, broadcast over arrays of any of the parameters
+    The rates default to the module constants above
+    '''
+    stroke_psc = arrival_rate_stroke_PSC if stroke_psc is None else stroke_psc
+    stroke_csc = arrival_rate_stroke_CSC if stroke_csc is None else stroke_csc
+    non_stroke = arrival_rate_non_stroke_csc_psc if non_stroke is None else non_stroke
+    stroke_rate = stroke_processing_rate if stroke_rate is None else stroke_rate
+    non_stroke_rate = non_stroke_processing_rate if non_stroke_rate is None else non_stroke_rate
+
+    stroke_arrival_rate = np.asarray(transfer_rate, dtype = float) * stroke_psc + stroke_csc
+    combined_arrival_rate = non_stroke + stroke_arrival_rate
+    beta = non_stroke / combined_arrival_rate
+    combined_processing_rate = non_stroke_rate * beta + stroke_rate * (1 - beta)
+    return combined_arrival_rate / combined_processing_rate
+
+
+def erlang_b(num_beds, load):
+    '''
+    Erlang-B blocking probability, broadcast over arrays of bed counts and loads
+    Uses the recurrence B(n) = a B(n-1) / (n + a B(n-1)), which stays between 0 and 1
+    so it is accurate for any number of beds
+
+    The recurrence runs once over the distinct loads, and every grid point
+    picks up its value when it reaches its own bed count
+    '''
+    num_beds, load = np.broadcast_arrays(np.asarray(num_beds, dtype = int), np.asarray(load, dtype = float))
+    shape = load.shape
+    num_beds = num_beds.ravel()
+    loads, which_load = np.unique(load.ravel(), return_inverse = True)
+
+    order = np.argsort(num_beds, kind = 'stable')
+    # order[starts[n]:starts[n + 1]] are the points with n beds
+    starts = np.searchsorted(num_beds[order], np.arange(int(num_beds.max(initial = 0)) + 2))
+
+    result = np.ones(num_beds.shape)
+    blocking = np.ones(loads.shape)
+    for n in range(1, len(starts) - 1):
+        blocking = loads * blocking / (n + loads * blocking)
+        points = order[starts[n]:starts[n + 1]]
+        result[points] = blocking[which_load[points]]
+    return result.reshape(shape)
+
+
+def state_distribution(num_beds, load):
+    '''
+    Probability of every number of beds filled (the truncated Poisson distribution),
+    broadcast over arrays of bed counts and loads
+    The states run along the last axis up to the largest bed count, states above
+    a grid point's own bed count get probability 0
+    Worked out in logs so it does not overflow for large bed counts
+    '''
+    num_beds, load = np.broadcast_arrays(np.asarray(num_beds, dtype = int), np.asarray(load, dtype = float))
+    states = np.arange(int(num_beds.max(initial = 0)) + 1)
+    log_factorials = np.concatenate([[0.0], np.cumsum(np.log(states[1:]))])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        log_terms = states * np.log(load)[..., None] - log_factorials
+    log_terms = np.where(states <= num_beds[..., None], log_terms, -np.inf)
+    # state 0 has term 1, also for a load of 0 (where 0 * log 0 came out as nan)
+    log_terms[..., 0] = 0.0
+
+    terms = np.exp(log_terms - log_terms.max(axis = -1, keepdims = True))
+    return terms / terms.sum(axis = -1, keepdims = True)
+
+
+def blocking_surface(bed_counts, transfer_rates, **rates):
+    '''
+    Blocking percentage over a grid, one row per bed count and one column per transfer rate
+    rates are passed on to offered_load
+    '''
+    load = offered_load(np.asarray(transfer_rates)[None, :], **rates)
+    return 100 * erlang_b(np.asarray(bed_counts)[:, None], load)
 
-    stroke_arrival_rate = transfer_rate*arrival_rate_stroke_PSC + arrival_rate_stroke_CSC
 
-    beta = arrival_rate_non_stroke_csc_psc / (arrival_rate_non_stroke_csc_psc + stroke_arrival_rate)
-    combined_arrival_rate = arrival_rate_non_stroke_csc_psc + stroke_arrival_rate
-    combined_processing_rate = non_stroke_processing_rate * beta + stroke_processing_rate * (1 - beta)
+def calculate_blocking_prob(num_beds, transfer_rate, plot = False, filename = ''):
 
-    alpha = combined_arrival_rate / combined_processing_rate
-    denom = [1, alpha]
-    for i in range(2, n + 1):
-        prev_value = denom[i-1]
-        next_value = alpha * prev_value / i
-        denom.append(next_value)
-    denom_sum = sum(denom)
-    # y_vals = denom[:]
+    n = num_beds
 
-    probs = [100 * x / denom_sum for x in denom]
-    blocking_prob = denom[-1] / denom_sum
+    alpha = offered_load(transfer_rate)
+    probs = list(100 * state_distribution(n, alpha))
+    blocking_prob = float(erlang_b(n, alpha))
 
     # print(probs)
 
@@ -89,15 +151,12 @@ p1 = .667
 # print(.231, calculate_blocking_prob(28, .231))
 
 def overall_plots(n, sim_type = ""):
-    block_prob_array = [calculate_blocking_prob(n, x/100) for x in range(0, 101)]
+    block_prob_array = list(blocking_surface([n], [x/100 for x in range(0, 101)])[0])
     plot_results(block_prob_array, filename = sim_type)
     return block_prob_array
 
 # def two_dim_plots(sim_type = "", save = False):
-#     twod_results = [
-#                 [calculate_blocking_prob(n, x / 100) for x in range(0, 101)]
-#                 for n in range(0, 50)
-#                 ]
+#     twod_results = blocking_surface(range(0, 50), [x / 100 for x in range(0, 101)])
 
 #     plt.subplots(figsize=(15,10))
 #     ax = sns.heatmap(twod_results, linewidth=0.0)
@@ -130,7 +189,8 @@ def save_results():
 # two_dim_plots("medium", save = True)
 # two_dim_plots("large", save = True)
 
-print(calculate_blocking_prob(28, 0.13))
+if __name__ == "__main__":
+    print(calculate_blocking_prob(28, 0.13))
 
 
 
@@ -0,0 +1,165 @@
+import heapq
+import itertools
+from bisect import insort
+from functools import partial
+
+
+# Event code of an arrival (simul2.ARRIVAL, Simulation checks they match), MergeEventList keeps those apart
+ARRIVAL_CODE = 0
+
+MIN_BUCKETS = 16 # a calendar never shrinks below this many buckets
+WIDTH_SAMPLE = 25 # events at the front of the calendar the bucket width is worked out from
+
+
+class HeapEventList(list):
+    '''
+    Binary heap of events, the list of tuples heapq works on
+    push and pop are bound to heapq, so they cost no more than calling heapq directly
+    '''
+    def __init__(self, events = ()):
+        list.__init__(self, events)
+        heapq.heapify(self)
+        self.push = partial(heapq.heappush, self)
+        self.pop = partial(heapq.heappop, self)
+
+    def peek(self):
+        '''
+        The first event without taking it off, None if there is none
+        '''
+        return self[0] if self else None
+
+
+class CalendarQueue:
+    '''
+    Calendar queue (Brown, 1988): the events are spread over a ring of buckets that are each
+    width long, a year being one turn of the ring, and every bucket is kept sorted.
+    pop walks the ring from the bucket of the last event taken off, so with about one event
+    per bucket both push and pop cost O(1) on average whatever the number of events
+
+    The ring doubles when there are more than two events per bucket and halves when there are
+    fewer than half, and every time it does the width is set again to three times the mean gap
+    between the first WIDTH_SAMPLE events (leaving out the gaps over twice the mean)
+    Events come off in exactly the same order as from HeapEventList
+    '''
+    def __init__(self, events = ()):
+        self.size = 0
+        self.build([], MIN_BUCKETS, 1.0)
+        for event in events:
+            self.push(event)
+
+    def build(self, events, number_of_buckets, width):
+        self.buckets = [[] for i in range(number_of_buckets)]
+        self.mask = number_of_buckets - 1
+        self.width = width
+        self.grow_at = 2 * number_of_buckets
+        self.shrink_at = number_of_buckets // 2 if number_of_buckets > MIN_BUCKETS else -1
+        self.current = 0 # bucket number (not wrapped around the ring) the next event is looked for from
+        events.sort()
+        for event in events:
+            self.buckets[int(event[0] / width) & self.mask].append(event)
+        if events:
+            self.current = int(events[0][0] / width)
+
+    def resize(self, number_of_buckets):
+        '''
+        Rebuild the ring with number_of_buckets buckets and a width tuned to the events in it
+        '''
+        events = list(self)
+        width = self.width
+        times = [event[0] for event in heapq.nsmallest(WIDTH_SAMPLE, events)]
+        gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+        if gaps and sum(gaps) > 0:
+            mean = sum(gaps) / len(gaps)
+            small = [gap for gap in gaps if gap <= 2 * mean]
+            width = 3 * sum(small) / len(small) or width
+        self.build(events, number_of_buckets, width)
+
+    def push(self, event):
+        number = int(event[0] / self.width)
+        insort(self.buckets[number & self.mask], event)
+        if number < self.current:
+            self.current = number
+        self.size += 1
+        if self.size > self.grow_at:
+            self.resize(2 * len(self.buckets))
+
+    def pop(self):
+        if not self.size:
+            raise IndexError("pop from an empty event list")
+        buckets = self.buckets
+        mask = self.mask
+        width = self.width
+        for number in range(self.current, self.current + len(buckets)):
+            bucket = buckets[number & mask]
+            # the first event of the bucket may be a year (or more) later
+            if bucket and int(bucket[0][0] / width) <= number:
+                break
+        else:
+            # nothing in the coming year, go straight to the first event
+            number = int(self.peek()[0] / width)
+            bucket = buckets[number & mask]
+
+        self.current = number
+        self.size -= 1
+        event = bucket.pop(0)
+        if self.size < self.shrink_at:
+            self.resize(len(buckets) // 2)
+        return event
+
+    def peek(self):
+        '''
+        The first event without taking it off, None if there is none
+        '''
+        return min((bucket[0] for bucket in self.buckets if bucket), default = None)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.buckets)
+
+
+class MergeEventList:
+    '''
+    The arrivals come from per hospital streams that are drawn ahead, so there is at most
+    one pending arrival per hospital: they are k-way merged in a heap of their own and
+    that merge is merged with a second heap holding every other event
+    Both heaps stay small (hospitals, occupied beds) instead of one holding their sum
+    Events come off in exactly the same order as from HeapEventList
+    '''
+    def __init__(self, events = ()):
+        events = list(events)
+        self.arrivals = [event for event in events if event[2] == ARRIVAL_CODE]
+        self.others = [event for event in events if event[2] != ARRIVAL_CODE]
+        heapq.heapify(self.arrivals)
+        heapq.heapify(self.others)
+
+    def push(self, event):
+        heapq.heappush(self.arrivals if event[2] == ARRIVAL_CODE else self.others, event)
+
+    def pop(self):
+        arrivals = self.arrivals
+        others = self.others
+        if others and (not arrivals or others[0] < arrivals[0]):
+            return heapq.heappop(others)
+        return heapq.heappop(arrivals)
+
+    def peek(self):
+        '''
+        The first event without taking it off, None if there is none
+        '''
+        return min(self.arrivals[:1] + self.others[:1], default = None)
+
+    def __len__(self):
+        return len(self.arrivals) + len(self.others)
+
+    def __iter__(self):
+        return itertools.chain(self.arrivals, self.others)
+
+
+# Event list backends by name, see Simulation
+EVENT_LISTS = {
+    'heap': HeapEventList,
+    'calendar': CalendarQueue,
+    'merge': MergeEventList,
+}
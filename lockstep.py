@@ -0,0 +1,132 @@
+import numpy as np
+
+import simul2
+
+
+LOCKSTEP_CHUNK_SIZE = 512 # arrivals drawn at a time for every replication
+
+# counts (see simul2.COUNT_NAMES) a patient with each value of the flags is part of
+MEMBERSHIP = np.zeros((8, len(simul2.COUNT_NAMES)))
+for flags in range(8):
+    MEMBERSHIP[flags, simul2.counts_for_flags(flags)] = 1.0
+
+
+def arrival_classes(config):
+    '''
+    The merged stream of patients that reach the CSC of a star network, split into classes
+    Returns (rates, kinds, flags, can_need_transfer) with one entry per class: a PSC only sends
+    on its ischemic patients with its transfer rate, so its thinned stream is still Poisson
+    '''
+    csc = [hospital for hospital in config.hospitals if hospital.kind == 'CSC']
+    if len(csc) != 1 or any(hospital.kind not in ['CSC', 'PSC'] for hospital in config.hospitals):
+        raise ValueError("The lockstep engine needs a star network with a single CSC")
+
+    rates = []
+    kinds = []
+    flags = []
+    can_need_transfer = []
+    for hospital in config.hospitals:
+        from_psc = simul2.FROM_PSC_FLAG if hospital.kind == 'PSC' else 0
+        keep_ischemic = hospital.transfer_rate if hospital.kind == 'PSC' else 1.0
+        stroke = hospital.arrival_rate_stroke
+        for rate, kind, flag, optional in [
+                (hospital.arrival_rate_non_stroke, simul2.NON_STROKE, 0, False),
+                (stroke * (1 - simul2.HEMORRHAGIC_PERCENTAGE) * keep_ischemic, simul2.ISCHEMIC, simul2.STROKE_FLAG, True),
+                (stroke * simul2.HEMORRHAGIC_PERCENTAGE, simul2.HEMORRHAGIC,
+                 simul2.STROKE_FLAG | simul2.TRANSFER_NEEDED_FLAG, False)]:
+            rates.append(rate)
+            kinds.append(kind)
+            flags.append(flag | from_psc)
+            can_need_transfer.append(optional)
+    return np.array(rates), np.array(kinds), np.array(flags), np.array(can_need_transfer)
+
+
+def run_lockstep(config, n, seed = None, chunk_size = None):
+    '''
+    Run n replications of a star network together, one arrival to the CSC of every replication per step
+
+    Each replication keeps the release times of its CSC beds in a row of an n x beds array,
+    sorted so that the first bed is the one that frees up first: an arrival is admitted
+    if that bed is free by then. Between two arrivals the sorted release times also give
+    how long every bed count lasted, for the occupancy histogram.
+    The time weighted class counts are added up at admission (each patient counts for
+    its stay, cut off at the duration)
+
+    Returns per replication metrics in the form of simul2.replication_metrics,
+    they agree with Simulation.run_simulation in distribution (not draw for draw)
+    '''
+    rng = np.random.default_rng(np.random.SeedSequence(seed))
+    chunk_size = chunk_size or LOCKSTEP_CHUNK_SIZE
+    duration = config.duration
+    beds = [hospital for hospital in config.hospitals if hospital.kind == 'CSC'][0].max_beds
+
+    rates, kinds, class_flags, can_need_transfer = arrival_classes(config)
+    total_rate = rates.sum()
+    cumulative = np.cumsum(rates / total_rate)
+    cumulative[-1] = 1.0
+    stays = np.array([config.non_stroke_duration, config.ischemic_rate, config.hemorrhagic_rate])[kinds]
+
+    release = np.zeros((n, beds))
+    state_times = np.zeros((n, beds + 1))
+    areas = np.zeros((n, len(simul2.COUNT_NAMES)))
+    arrival_count = np.zeros(n, dtype = np.int64)
+    rejected_count = np.zeros(n, dtype = np.int64)
+    should_be_rej = np.zeros(n, dtype = np.int64)
+    should_not_be_rej = np.zeros(n, dtype = np.int64)
+
+    # time spent at bed count (beds - j) between two times, j = 0 .. beds, given sorted release times
+    def add_state_times(start, end):
+        cut = np.clip(release, start[:, None], end[:, None])
+        bounds = np.concatenate([start[:, None], cut, end[:, None]], axis = 1)
+        state_times[:, ::-1] += np.diff(bounds, axis = 1)
+
+    now = np.zeros(n)
+    while (now < duration).any():
+        times = now[:, None] + np.cumsum(rng.exponential(1.0 / total_rate, (n, chunk_size)), axis = 1)
+        classes = np.searchsorted(cumulative, rng.random((n, chunk_size)), side = 'right')
+        needs_transfer = rng.random((n, chunk_size)) < config.transfer_needed_percentage
+        flags = class_flags[classes] | np.where(can_need_transfer[classes] & needs_transfer,
+                                                simul2.TRANSFER_NEEDED_FLAG, 0)
+        leaves = times + rng.exponential(stays[classes])
+
+        # only the admission decisions need a step per arrival, the counters are worked out per chunk
+        active = times < duration
+        admitted = np.zeros((n, chunk_size), dtype = bool)
+        for k in range(chunk_size):
+            arrival = times[:, k]
+            # once a replication's next arrival is past the duration it just sits at the duration
+            step_end = np.minimum(arrival, duration)
+            add_state_times(now, step_end)
+            now = step_end
+            if not active[:, k].any():
+                break
+
+            admit = active[:, k] & (release[:, 0] <= arrival)
+            admitted[:, k] = admit
+            release[:, 0] = np.where(admit, leaves[:, k], release[:, 0])
+            release.sort(axis = 1)
+
+        blocked = active & ~admitted
+        stroke = (flags & simul2.STROKE_FLAG) != 0
+        needed = (flags & simul2.TRANSFER_NEEDED_FLAG) != 0
+        arrival_count += active.sum(axis = 1)
+        rejected_count += blocked.sum(axis = 1)
+        should_be_rej += (blocked & stroke & needed).sum(axis = 1)
+        should_not_be_rej += (blocked & stroke & ~needed).sum(axis = 1)
+        counted = np.where(admitted, np.minimum(leaves, duration) - times, 0.0)
+        for patient_flags in range(len(MEMBERSHIP)):
+            areas += np.where(flags == patient_flags, counted, 0.0).sum(axis = 1)[:, None] * MEMBERSHIP[patient_flags]
+
+    list_of_metrics = []
+    for r in range(n):
+        metrics = {
+            'arrival_count': int(arrival_count[r]),
+            'rejected_count': int(rejected_count[r]),
+            'should_be_rej': int(should_be_rej[r]),
+            'should_not_be_rej': int(should_not_be_rej[r]),
+            'hist_values': (state_times[r] / duration).tolist(),
+        }
+        for i, name in enumerate(simul2.AVERAGE_NAMES):
+            metrics[name] = float(areas[r, i] / duration)
+        list_of_metrics.append({name: metrics[name] for name in simul2.METRIC_ATTRIBUTES})
+    return list_of_metrics
@@ -0,0 +1,144 @@
+import numpy as np
+from collections import namedtuple
+from statistics import NormalDist
+
+
+# Point estimate with the half width of its confidence interval
+Estimate = namedtuple('Estimate', ['mean', 'half_width', 'std', 'n'])
+
+
+# Up to this many degrees of freedom t_critical solves the exact distribution function
+EXACT_T_DF = 100
+
+
+def t_coverage(t, df):
+    '''
+    P(|T| < t) for Student's t with an integer number of degrees of freedom,
+    from the finite series in theta = atan(t / sqrt(df)) (Abramowitz and Stegun 26.7.3)
+    '''
+    theta = np.arctan(t / np.sqrt(df))
+    cos_squared = np.cos(theta)**2
+    if df % 2:
+        term = total = 1.0
+        for k in range(3, df - 1, 2):
+            term *= (k - 1) / k * cos_squared
+            total += term
+        series = np.sin(theta) * np.cos(theta) * total if df > 1 else 0.0
+        return 2 / np.pi * (theta + series)
+
+    term = total = 1.0
+    for k in range(2, df - 1, 2):
+        term *= (k - 1) / k * cos_squared
+        total += term
+    return np.sin(theta) * total
+
+
+def t_critical(df, confidence = 0.95):
+    '''
+    Two sided critical value of Student's t distribution
+    Exact for df = 1, 2, solved from the exact distribution function up to EXACT_T_DF,
+    and a Cornish-Fisher expansion around the normal quantile above that
+    (within 1e-5 of the exact value there, for confidence levels up to 99.9%)
+    '''
+    p = 0.5 + confidence / 2
+    if df <= 0:
+        return float('inf')
+    if df == 1:
+        return np.tan(np.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) * np.sqrt(2 / (4 * p * (1 - p)))
+
+    z = NormalDist().inv_cdf(p)
+    g1 = (z**3 + z) / 4
+    g2 = (5 * z**5 + 16 * z**3 + 3 * z) / 96
+    g3 = (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / 384
+    g4 = (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / 92160
+    expansion = z + g1 / df + g2 / df**2 + g3 / df**3 + g4 / df**4
+    if df > EXACT_T_DF or df != int(df):
+        return expansion
+
+    # bisection, the value is between the normal quantile and the one for df = 2
+    low, high = z, max(expansion, (2 * p - 1) * np.sqrt(2 / (4 * p * (1 - p))))
+    for i in range(100):
+        middle = (low + high) / 2
+        if t_coverage(middle, int(df)) < confidence:
+            low = middle
+        else:
+            high = middle
+        if high - low < 1e-12 * high:
+            break
+    return (low + high) / 2
+
+
+def confidence_interval(samples, confidence = 0.95):
+    '''
+    Mean of independent samples with the half width of its t confidence interval
+    NaN samples (ratios with nothing to divide by) are left out
+    '''
+    samples = np.asarray(samples, dtype = float)
+    samples = samples[~np.isnan(samples)]
+    n = len(samples)
+    mean = samples.mean() if n else float('nan')
+    if n < 2:
+        return Estimate(mean, float('inf'), float('nan'), n)
+
+    std = samples.std(ddof = 1)
+    return Estimate(mean, t_critical(n - 1, confidence) * std / np.sqrt(n), std, n)
+
+
+def paired_difference(first, second, confidence = 0.95):
+    '''
+    Estimate of E[second - first] from paired samples (replication k of both runs
+    on the same random numbers), the variance is that of the differences
+    '''
+    return confidence_interval(np.asarray(second, dtype = float) - np.asarray(first, dtype = float), confidence)
+
+
+def mser(observations, batch_size = 5):
+    '''
+    MSER-m warm-up truncation point of a series of observations (MSER-5 by default)
+    The observations are averaged in batches of batch_size, and the number of batches
+    to drop is the one that minimises the standard error of the mean of the rest,
+    looking only over the first half of the batches
+    Returns the number of observations to drop
+    '''
+    observations = np.asarray(observations, dtype = float)
+    k = len(observations) // batch_size
+    if k < 2:
+        return 0
+
+    batches = observations[:k * batch_size].reshape(k, batch_size).mean(axis = 1)
+    # sums over batches d .. k - 1 for every d
+    remaining = np.arange(k, 0, -1)
+    total = np.cumsum(batches[::-1])[::-1]
+    total_squares = np.cumsum((batches**2)[::-1])[::-1]
+    statistic = (total_squares - total**2 / remaining) / remaining**2
+    return int(np.argmin(statistic[:k // 2 + 1])) * batch_size
+
+
+def lag1_autocorrelation(samples):
+    '''
+    Lag-1 sample autocorrelation of a series
+    '''
+    samples = np.asarray(samples, dtype = float)
+    deviations = samples - samples.mean()
+    denominator = np.dot(deviations, deviations)
+    if len(samples) < 3 or denominator == 0:
+        return 0.0
+    return float(np.dot(deviations[:-1], deviations[1:]) / denominator)
+
+
+def choose_batch_size(observations, min_batches = 10, threshold = 0.1):
+    '''
+    Number of consecutive observations to put in each batch for batch means:
+    the batch size is doubled until the lag-1 autocorrelation of the batch means is below
+    threshold, or until doubling again would leave fewer than min_batches batches
+    '''
+    observations = np.asarray(observations, dtype = float)
+    batch_size = 1
+    while True:
+        k = len(observations) // batch_size
+        batches = observations[:k * batch_size].reshape(k, batch_size).mean(axis = 1)
+        if lag1_autocorrelation(batches) < threshold or len(observations) // (2 * batch_size) < min_batches:
+            return batch_size
+        batch_size *= 2
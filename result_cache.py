@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+
+
+DEFAULT_DIRECTORY = '.simulation_cache'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def fingerprint(parameters):
+    '''
+    Content hash of anything json can write (dict keys in sorted order)
+    '''
+    text = json.dumps(parameters, sort_keys = True, separators = (',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    '''
+    Directory of json results, one file per key
+    Reading an entry marks it as used (its modification time is bumped), and once the
+    files add up to more than max_bytes the least recently used ones are deleted
+    '''
+    def __init__(self, directory = DEFAULT_DIRECTORY, max_bytes = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None # bytes on disk, counted the first time something is written
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        '''
+        The result stored under key, or None
+        '''
+        path = self.path(key)
+        try:
+            with open(path, 'r') as entry:
+                result = json.load(entry)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        '''
+        Store a result under key, written to a temporary file and moved into place
+        so a reader never sees half an entry
+        '''
+        path = self.path(key)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as entry:
+            json.dump(result, entry)
+        if self.size is None:
+            self.size = sum(size for size, mtime, name in self.entries())
+        if os.path.exists(path):
+            self.size -= os.path.getsize(path)
+        os.replace(temporary_path, path)
+        self.size += os.path.getsize(path)
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        '''
+        (size, last use, file name) of every entry
+        '''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_size, stat.st_mtime, entry.name))
+        return entries
+
+    def evict(self):
+        '''
+        Delete the least recently used entries until the cache fits in max_bytes
+        '''
+        entries = sorted(self.entries(), key = lambda entry: entry[1])
+        self.size = sum(size for size, mtime, name in entries)
+        for size, mtime, name in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            self.size -= size
+
+    def clear(self):
+        for size, mtime, name in self.entries():
+            os.remove(os.path.join(self.directory, name))
+        self.size = 0
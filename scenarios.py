@@ -0,0 +1,297 @@
+import csv
+import math
+import os
+import re
+from collections import namedtuple
+
+
+# Fixed description of a hospital, shared by every replication that runs it
+# kind is the name of the Hospital class to build ('CSC' or 'PSC')
+# transfer_to is the CSC a PSC sends its patients to, overflow_to the CSC they go to when that one is full
+# (None for the defaults: the first CSC, and no overflow)
+HospitalConfig = namedtuple('HospitalConfig', ['kind', 'pid', 'max_beds', 'transfer_rate',
+                                               'arrival_rate_stroke', 'arrival_rate_non_stroke',
+                                               'transfer_to', 'overflow_to'], defaults = [None, None])
+
+# Everything read out of the config file
+# hospitals is a tuple of HospitalConfigs, shared by every replication (each one builds its own Hospitals)
+Config = namedtuple('Config', ['ischemic_rate', 'hemorrhagic_rate', 'non_stroke_duration',
+                               'transfer_needed_percentage', 'duration', 'number_of_simulations',
+                               'hospitals'])
+
+# A named Config, source is where it was read from ("file:line")
+Scenario = namedtuple('Scenario', ['name', 'source', 'config'])
+
+
+class ConfigError(ValueError):
+    '''
+    A config file that does not follow the schema, the message says where
+    '''
+    pass
+
+
+# The names every parameter is known by in the config files (compared without case and punctuation)
+PARAMETER_NAMES = {
+    'ischemic_rate': ["Ischemic Stroke Length of Length of Stay", "Ischemic Stroke Length of Stay",
+                      "Average Ischemic Stroke Treament Time", "Average Ischemic Stroke Treatment Time"],
+    'hemorrhagic_rate': ["Hemorrhagic Stroke Length of Stay", "Average Hemorrhagic Stroke Treatment Time"],
+    'non_stroke_duration': ["Non Stroke Length of Stay", "Average Non Stroke Treatment Time"],
+    'non_stroke_percentage': ["Percentage of all patients that are not stroke patients"],
+    'transfer_needed_percentage': ["Percentage of Ischemic Patients where Transfer is Needed",
+                                   "Percentage of Patients where Transfer is Needed"],
+    'duration': ["Duration of Simulation"],
+    'number_of_simulations': ["Number of Simulations"],
+}
+
+# Only needed by files that give total arrival rates
+OPTIONAL_PARAMETERS = ['non_stroke_percentage']
+
+# The hospital table columns, by section
+# 'arrival_rate' is the older total rate, split with the non stroke percentage
+# the routing columns are optional and name a CSC (by its hospital name or id)
+COLUMN_NAMES = {
+    'CSC': {
+        'max_beds': ["Number of Beds in ICU"],
+        'arrival_rate_stroke': ["Arrival Rate of Patients to the ICU w/ Stroke"],
+        'arrival_rate_non_stroke': ["Arrival Rate of Non Stroke Patients to the ICU"],
+        'arrival_rate': ["Arrival Rate of Patients to the ICU"],
+        'overflow_to': ["Overflow To", "Secondary CSC"],
+    },
+    'PSC': {
+        'transfer_rate': ["Transfer Rate"],
+        'arrival_rate_stroke': ["Arrival Rate of Stroke Patients"],
+        'arrival_rate_non_stroke': ["Rate of Non Stroke Patients Sent to the CSC"],
+        'arrival_rate': ["Arrival Rate of Patients to the Hospital"],
+        'transfer_to': ["Transfer To", "Primary CSC"],
+        'overflow_to': ["Overflow To", "Secondary CSC"],
+    },
+}
+
+# Columns every hospital table has to have (the arrival rates are checked apart, they come in two forms)
+REQUIRED_COLUMNS = {'CSC': ['max_beds'], 'PSC': ['transfer_rate']}
+
+SECTION_NAMES = {"CSC Configuration:": 'CSC', "PSC Configuration:": 'PSC'}
+
+# Parsed scenarios by (path, modification time, size), so reading a file again is free
+PARSED = {}
+
+
+def normalize(name):
+    return re.sub(r'[^a-z0-9]+', ' ', name.lower()).strip()
+
+
+def clean(cell):
+    # byte order marks also turn up in the middle of files that were concatenated
+    return cell.replace('\ufeff', '').strip()
+
+
+def lookup(names):
+    return {normalize(alias): key for key, aliases in names.items() for alias in aliases}
+
+
+PARAMETER_LOOKUP = lookup(PARAMETER_NAMES)
+COLUMN_LOOKUP = {kind: lookup(columns) for kind, columns in COLUMN_NAMES.items()}
+
+
+def parse_number(text, where, what, integer = False, low = None, high = None, above = None):
+    '''
+    A finite number out of a cell, checked against [low, high] (or (above, high] when above is given)
+    '''
+    try:
+        value = int(text) if integer else float(text)
+    except ValueError:
+        raise ConfigError("{}: {} should be {}, got {!r}".format(where, what, "an integer" if integer else "a number", text))
+    if not math.isfinite(value):
+        raise ConfigError("{}: {} should be a finite number, got {!r}".format(where, what, text))
+    if ((low is not None and value < low) or (above is not None and value <= above)
+            or (high is not None and value > high)):
+        raise ConfigError("{}: {} = {} is out of range {}{}, {}]".format(
+            where, what, value, "(" if above is not None else "[", low if above is None else above, high))
+    return value
+
+
+def split_blocks(rows, filename):
+    '''
+    Split a file into (name, first row, rows) per scenario
+    Scenarios start at a "Scenario:,<name>" row, a file without any is one scenario named after it
+    '''
+    blocks = []
+    name = os.path.splitext(os.path.basename(filename))[0]
+    start = 0
+    for i, row in enumerate(rows):
+        if row and clean(row[0]) == "Scenario:":
+            if any(clean(cell) for r in rows[start:i] for cell in r):
+                blocks.append((name, start, rows[start:i]))
+            name = clean(row[1]) if len(row) > 1 and clean(row[1]) else "{}#{}".format(name, len(blocks) + 1)
+            start = i + 1
+    blocks.append((name, start, rows[start:]))
+    return blocks
+
+
+def parse_block(rows, filename, first_line):
+    '''
+    One scenario out of its rows, every row is checked against the schema
+    '''
+    parameters = {}
+    sections = {'CSC': [], 'PSC': []}
+    section = None
+    columns = None
+    for offset, row in enumerate(rows):
+        where = "{}:{}".format(filename, first_line + offset + 1)
+        cells = [clean(cell) for cell in row]
+        if not any(cells):
+            continue
+        head = cells[0]
+
+        if head == "Parameters":
+            section, columns = 'Parameters', None
+        elif head in SECTION_NAMES:
+            section = SECTION_NAMES[head]
+            columns = {}
+            for index, cell in enumerate(cells[2:], 2):
+                if not cell:
+                    continue
+                key = COLUMN_LOOKUP[section].get(normalize(cell))
+                if key is None:
+                    raise ConfigError("{}: unknown {} column {!r}".format(where, section, cell))
+                columns[key] = index
+            for key in REQUIRED_COLUMNS[section]:
+                if key not in columns:
+                    raise ConfigError("{}: the {} table has no {!r} column".format(
+                        where, section, COLUMN_NAMES[section][key][0]))
+        elif section == 'Parameters':
+            key = PARAMETER_LOOKUP.get(normalize(head))
+            if key is None:
+                raise ConfigError("{}: unknown parameter {!r}".format(where, head))
+            if key in parameters:
+                raise ConfigError("{}: parameter {!r} is given twice".format(where, head))
+            if len(cells) < 2 or not cells[1]:
+                raise ConfigError("{}: parameter {!r} has no value".format(where, head))
+            parameters[key] = (cells[1], where)
+        elif section in sections:
+            if head:
+                raise ConfigError("{}: unexpected {!r} in the {} table".format(where, head, section))
+            sections[section].append((cells, where, columns))
+        else:
+            raise ConfigError("{}: row outside of any section".format(where))
+
+    missing = [key for key in PARAMETER_NAMES if key not in parameters and key not in OPTIONAL_PARAMETERS]
+    if missing:
+        raise ConfigError("{}: missing parameters {}".format(filename, ", ".join(PARAMETER_NAMES[key][0] for key in missing)))
+
+    def parameter(key, **limits):
+        text, where = parameters[key]
+        return parse_number(text, where, PARAMETER_NAMES[key][0], **limits)
+
+    non_stroke_percentage = None
+    if 'non_stroke_percentage' in parameters:
+        non_stroke_percentage = parameter('non_stroke_percentage', low = 0, high = 1)
+
+    hospitals = []
+    names = {}
+    routes = []
+    for kind in ['CSC', 'PSC']:
+        for cells, where, columns in sections[kind]:
+            def cell(key, **limits):
+                index = columns[key]
+                text = cells[index] if index < len(cells) else ""
+                return parse_number(text, where, COLUMN_NAMES[kind][key][0], **limits)
+
+            max_beds = cell('max_beds', integer = True, low = 1) if kind == 'CSC' else 0
+            transfer_rate = cell('transfer_rate', low = 0, high = 1) if kind == 'PSC' else 0.0
+            if 'arrival_rate_stroke' in columns and 'arrival_rate_non_stroke' in columns:
+                stroke = cell('arrival_rate_stroke', low = 0)
+                non_stroke = cell('arrival_rate_non_stroke', low = 0)
+            elif 'arrival_rate' in columns:
+                if non_stroke_percentage is None:
+                    raise ConfigError("{}: total arrival rates need the parameter {!r}".format(
+                        where, PARAMETER_NAMES['non_stroke_percentage'][0]))
+                total = cell('arrival_rate', low = 0)
+                stroke = total * (1 - non_stroke_percentage)
+                # with total rates the PSCs keep their non stroke patients (see instructions.md)
+                non_stroke = total * non_stroke_percentage if kind == 'CSC' else 0.0
+            else:
+                raise ConfigError("{}: the {} table has no arrival rate columns".format(where, kind))
+
+            if len(cells) > 1 and cells[1]:
+                names.setdefault(cells[1], len(hospitals))
+            routes.append([cells[columns[key]] if key in columns and columns[key] < len(cells) else ""
+                           for key in ['transfer_to', 'overflow_to']] + [where])
+            hospitals.append(HospitalConfig(kind, len(hospitals), max_beds, transfer_rate, stroke, non_stroke))
+
+    cscs = [hospital.pid for hospital in hospitals if hospital.kind == 'CSC']
+    if not cscs:
+        raise ConfigError("{}: there has to be at least one CSC".format(filename))
+
+    def route(text, where):
+        if not text:
+            return None
+        pid = names.get(text)
+        if pid is None and text.isdigit():
+            pid = int(text)
+        if pid not in cscs:
+            raise ConfigError("{}: patients can only be routed to a CSC, {!r} is not one".format(where, text))
+        return pid
+
+    for i, (transfer_to, overflow_to, where) in enumerate(routes):
+        hospital = hospitals[i]
+        transfer_to = route(transfer_to, where)
+        overflow_to = route(overflow_to, where)
+        primary = hospital.pid if hospital.kind == 'CSC' else (cscs[0] if transfer_to is None else transfer_to)
+        if overflow_to == primary:
+            raise ConfigError("{}: patients can not overflow to the CSC they were sent to".format(where))
+        hospitals[i] = hospital._replace(transfer_to = transfer_to, overflow_to = overflow_to)
+
+    return Config(parameter('ischemic_rate', low = 0),
+                  parameter('hemorrhagic_rate', low = 0),
+                  parameter('non_stroke_duration', low = 0),
+                  parameter('transfer_needed_percentage', low = 0, high = 1),
+                  parameter('duration', above = 0),
+                  parameter('number_of_simulations', integer = True, above = 0),
+                  tuple(hospitals))
+
+
+def load_file(filename):
+    '''
+    Every scenario in one config file, parsed once per version of the file
+    '''
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+    if key not in PARSED:
+        with open(filename, 'r', encoding = 'utf-8-sig', newline = '') as csvfile:
+            rows = list(csv.reader(csvfile, delimiter = ','))
+        PARSED[key] = tuple(Scenario(name, "{}:{}".format(filename, first + 1), parse_block(block, filename, first))
+                            for name, first, block in split_blocks(rows, filename))
+    return PARSED[key]
+
+
+def load_scenarios(path):
+    '''
+    The scenarios in a config file, or in every .csv file of a directory (in name order)
+    Raises ConfigError on the first thing that does not follow the schema, or on repeated names
+    '''
+    if os.path.isdir(path):
+        filenames = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.lower().endswith('.csv')]
+    else:
+        filenames = [path]
+
+    scenarios = []
+    seen = {}
+    for filename in filenames:
+        for scenario in load_file(filename):
+            if scenario.name in seen:
+                raise ConfigError("{}: scenario {!r} was already defined at {}".format(
+                    scenario.source, scenario.name, seen[scenario.name]))
+            seen[scenario.name] = scenario.source
+            scenarios.append(scenario)
+    return scenarios
+
+
+def load_config(filename):
+    '''
+    The Config of a file holding a single scenario
+    '''
+    scenarios = load_file(filename)
+    if len(scenarios) != 1:
+        raise ConfigError("{}: holds {} scenarios, expected one".format(filename, len(scenarios)))
+    return scenarios[0].config
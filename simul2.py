@@ -1,11 +1,22 @@
 import numpy as np
-import heapq
 import time
-import csv
 import matplotlib.pyplot as plt
-import copy
+import itertools
+import json
+import os
 from operator import add
 import pandas as pd
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from blocking_prob import erlang_b
+from event_lists import ARRIVAL_CODE, EVENT_LISTS
+from output_analysis import choose_batch_size, confidence_interval, mser, paired_difference
+from result_cache import ResultCache, fingerprint
+from scenarios import Config, HospitalConfig, load_config, load_scenarios
+from timelines import BAND_PERCENTILES, TimelineRecorder, interval_edges, lttb, percentile_bands, step_points
+from trace_recorder import ADMISSION, DISCHARGE, OVERFLOW, REJECTION
 
 # Constants
 ISCHEMIC_RATE = None # days
@@ -17,6 +28,22 @@ TRANSFER_NEEDED_PERCENTAGE = None
 NON_STROKE_PATIENT_DURATION = None
 PERCENTAGE_NON_STROKE = None
 NUMBER_OF_SIMULATIONS = None
+ARRIVAL_CHUNK_SIZE = 1024 # arrivals drawn per batch by each ArrivalSource
+MIN_ARRIVAL_CHUNK_SIZE = 16 # smallest batch drawn for a quiet hospital, see ArrivalSource
+ARRIVAL_CHUNK_DAYS = 1000 # a batch holds at most the arrivals expected over this many days, see ArrivalSource
+CHECKPOINT_SEGMENT = 100000 # events between clock checks when checkpointing every so many seconds
+WARMUP_INTERVAL = 1.0 # days between occupancy observations for warm-up detection
+MSER_BATCH_SIZE = 5 # observations per batch for MSER
+MIN_BATCHES = 10 # fewest batches batch means will split a run into
+ENGINE_VERSION = 5 # part of every cache key, bump it whenever a change alters the results for a given seed
+SAMPLE_EVENTS = 1024 # events between clock checks when sampling the event rate
+
+HEMORRHAGIC_PERCENTAGE = .13
+
+# Patient kinds, as stored in the PatientTable
+NON_STROKE = 0
+ISCHEMIC = 1
+HEMORRHAGIC = 2
 
 class Patient:
     '''
@@ -24,13 +51,21 @@ class Patient:
     Contains a unique ID (essentially used for comparison with other patients)
     Spawn Time - time that the patient was sent away from hospital
     Duration - The processing time they would see at the CSC
+
+    The stroke type, duration and transfer flag can be handed in already drawn,
+    otherwise they are drawn here one at a time
+    The simulation itself keeps its patients in a PatientTable, this is the one object per patient form
     '''
-    def __init__(self, pid, current_time, from_psc):
+    def __init__(self, pid, current_time, from_psc, stroke_type = None, duration = None, transfer_needed = None):
         self.id = pid
         self.spawn_time = current_time
         self.from_psc = from_psc
 
-        if np.random.uniform() < .13:
+        if stroke_type is not None:
+            self.stroke_type = stroke_type
+            self.duration = duration
+            self.transfer_needed = transfer_needed
+        elif np.random.uniform() < HEMORRHAGIC_PERCENTAGE:
             self.stroke_type = "HEMORRHAGIC"
             self.duration = np.random.exponential(HEMORRHAGIC_RATE)
             self.transfer_needed = True
@@ -55,33 +90,137 @@ class NonStrokePatient:
     Spawn Time - time that the patient was sent away from hospital
     Duration - The processing time they would see at the CSC
     '''
-    def __init__(self, pid, current_time, from_psc):
+    def __init__(self, pid, current_time, from_psc, duration = None):
         self.id = pid
         self.spawn_time = current_time
         self.from_psc = from_psc
-        self.duration = np.random.exponential(NON_STROKE_PATIENT_DURATION)
+        if duration is None:
+            duration = np.random.exponential(NON_STROKE_PATIENT_DURATION)
+        self.duration = duration
         self.completion_time = self.spawn_time + self.duration
 
     def update_completion_time(self, duration):
         self.completion_time += duration
 
 
-class Event:
+# Event codes, the third entry of every event on the queue
+# an ARRIVAL comes off the hospital's own arrival stream, a TRANSFER is sent over from another hospital
+ARRIVAL = 0
+TRANSFER = 1
+DEPARTURE = 2
+EVENT_NAMES = ["Arrival", "Transfer", "Departure"]
+
+# What each random stream is used for, every hospital has one of each
+ARRIVAL_STREAM = 0 # inter-arrival gaps
+PATIENT_TYPE_STREAM = 1 # stroke / non stroke and hemorrhagic / ischemic
+TRANSFER_NEEDED_STREAM = 2
+LENGTH_OF_STAY_STREAM = 3
+TRANSFER_COIN_STREAM = 4 # whether a PSC sends an ischemic stroke on
+STREAM_NAMES = ["arrival", "patient type", "transfer needed", "length of stay", "transfer coin"]
+
+# Patient flags, as stored in the PatientTable
+STROKE_FLAG = 4
+TRANSFER_NEEDED_FLAG = 2
+FROM_PSC_FLAG = 1
+
+# The counts every hospital keeps (and follows with a time weighted average)
+COUNT_NAMES = [
+    'bed_count',
+    'stroke_patient_count',
+    'should_be_at_csc',
+    'should_not_be_at_csc',
+    'stroke_from_psc',
+    'stroke_from_csc',
+    'non_stroke_from_psc',
+    'non_stroke_from_csc'
+]
+
+# Hospital attribute holding the time weighted average of each count
+AVERAGE_NAMES = [
+    'average_bed_count',
+    'average_stroke_count',
+    'average_should_be',
+    'average_should_not',
+    'average_psc',
+    'average_csc',
+    'average_non_stroke_psc',
+    'average_non_stroke_csc'
+]
+
+
+def counts_for_flags(flags):
     '''
-    Event class
-    These are the different kinds of events that take place at given location
+    Indices into COUNT_NAMES of the counts a patient with these flags is part of
     '''
-    def __init__(self, patient, completion_time, event_type, hospital_id):
-        self.patient = patient
-        self.completion_time = completion_time
-        self.event_type = event_type
-        self.hospital_id = hospital_id
+    names = ['bed_count']
+    if flags & STROKE_FLAG:
+        names.append('stroke_patient_count')
+        names.append('should_be_at_csc' if flags & TRANSFER_NEEDED_FLAG else 'should_not_be_at_csc')
+        names.append('stroke_from_psc' if flags & FROM_PSC_FLAG else 'stroke_from_csc')
+    else:
+        names.append('non_stroke_from_psc' if flags & FROM_PSC_FLAG else 'non_stroke_from_csc')
+    return tuple(COUNT_NAMES.index(name) for name in names)
 
-    def __lt__(self, other):
-        return self.completion_time <= other.completion_time
+COUNT_GROUPS = [counts_for_flags(flags) for flags in range(8)]
 
-    def pprint(self):
-        print("{} at time {}, hospital {}".format(self.event_type, self.completion_time, self.hospital_id))
+
+class PatientTable:
+    '''
+    Struct-of-arrays store for the patients in flight, a patient is just an index into the columns
+    kind is one of the NON_STROKE / ISCHEMIC / HEMORRHAGIC codes, flags is made of the *_FLAG bits,
+    origin is the id of the hospital the patient first arrived at (it picks the route, see Routing)
+    Slots of patients that have left the system (departed, rejected, not transferred)
+    are handed out again, so the table only grows to the peak number in flight
+    '''
+    def __init__(self):
+        self.spawn_time = array('d')
+        self.completion_time = array('d')
+        self.kind = array('b')
+        self.flags = array('b')
+        self.origin = array('i')
+        self.free = []
+
+    def add(self, spawn_time, duration, kind, flags, origin = 0):
+        '''
+        Store a patient, returns its index
+        '''
+        if self.free:
+            index = self.free.pop()
+            self.spawn_time[index] = spawn_time
+            self.completion_time[index] = spawn_time + duration
+            self.kind[index] = kind
+            self.flags[index] = flags
+            self.origin[index] = origin
+            return index
+
+        self.spawn_time.append(spawn_time)
+        self.completion_time.append(spawn_time + duration)
+        self.kind.append(kind)
+        self.flags.append(flags)
+        self.origin.append(origin)
+        return len(self.kind) - 1
+
+    def remove(self, index):
+        '''
+        The patient has left the system, its slot can be reused
+        '''
+        self.free.append(index)
+
+    def __len__(self):
+        return len(self.kind) - len(self.free)
+
+
+# Running totals of a hospital at a point in time, see Hospital.snapshot
+# (overflow_count defaults to 0 for checkpoints written before it was kept)
+Snapshot = namedtuple('Snapshot', ['time', 'areas', 'state_times', 'arrival_count', 'rejected_count',
+                                   'should_be_rej', 'should_not_be_rej', 'overflow_count'], defaults = [0])
+
+
+def format_event(event):
+    '''
+    Events are (time, sequence number, event code, hospital id, patient) tuples
+    '''
+    return "{} at time {}, hospital {}".format(EVENT_NAMES[event[2]], event[0], event[3])
 
 
 
@@ -91,123 +230,188 @@ class Hospital:
     Parent class for CSC and PSC
     Store a bunch of information regarding the rates
     Stores a bunch of meta data about the simulation process
+
+    The counts (see COUNT_NAMES) are followed by online time weighted averages,
+    the full (count, time) stamp lists are only recorded when trace is switched on
+
+    process_arrival / process_departure are handed the time and the patient of the event,
+    and hand back the (time, event code, hospital id) of the follow up event or None
+
+    transfer_to / overflow_to are the routes of the patients arriving here (see Routing),
+    the class defaults are used when they are None
     '''
-    def __init__(self, pid, number_of_beds, transfer_rate, arrival_rate_stroke, arrival_rate_non_stroke):
+    def __init__(self, pid, number_of_beds, transfer_rate, arrival_rate_stroke, arrival_rate_non_stroke, trace = False,
+                 transfer_to = None, overflow_to = None):
         self.pid = pid
-        self.number_spawned = 0
+        if transfer_to is not None:
+            self.transfer_to = transfer_to
+        self.overflow_to = overflow_to
         self.max_beds = number_of_beds
-        self.bed_count = 0
         self.transfer_rate = transfer_rate
         self.arrival_rate_stroke = arrival_rate_stroke
         self.arrival_rate_non_stroke = arrival_rate_non_stroke
+        self.trace = trace
+        self.reset()
+
+    def reset(self):
+        '''
+        Empty the hospital and clear every counter and average, ready for a new replication
+        '''
+        self.number_spawned = 0
+        self.bed_count = 0
         self.rejected_count = 0
+        self.arrival_count = 0
         self.time_stamps = []
         self.should_be_there_stamps = []
         self.should_not_be_there_stamps = []
         self.stroke_patient_stamps = []
-        self.stroke_patient_count = 0
-        self.should_be_at_csc = 0
-        self.should_not_be_at_csc = 0
         self.average_bed_count = 0
         self.average_stroke_count = 0
         self.average_should_be = 0
         self.average_should_not = 0
         self.should_be_rej = 0
         self.should_not_be_rej = 0
+        self.overflow_count = 0 # rejected patients that were sent on to their overflow CSC
         self.hist_values = []
-        self.stroke_from_psc = 0 
-        self.stroke_from_csc = 0 
         self.psc_stroke_stamps = []
         self.csc_stroke_stamps = []
-        self.non_stroke_from_psc = 0
-        self.non_stroke_from_csc = 0
         self.psc_non_stroke_stamps = []
         self.csc_non_stroke_stamps = []
         self.average_psc = 0
         self.average_csc = 0
         self.average_non_stroke_psc = 0
         self.average_non_stroke_csc = 0
-    
-    def process_departure(self, departure_event):
+        self.warmup = None # Snapshot taken at the end of the warm-up, see discard_warmup
+        self.end_time = None # time the run stopped at, set by the Simulation once it has run
+        self.streams = None # random generators indexed by *_STREAM, handed out by the Simulation that runs the hospital
+        self.patients = None # PatientTable, handed out by the Simulation as well
+        self.recorder = None # TraceRecorder that every change of state is streamed to, if any
+        self.routing = None # Routing of the whole network, handed out by the Simulation as well
+
+        # one entry per COUNT_NAMES: the count, the area under it up to its last change and the time of that change
+        self.counts = [0 for name in COUNT_NAMES]
+        self.areas = [0.0 for name in COUNT_NAMES]
+        self.last_change = [0.0 for name in COUNT_NAMES]
+        # time spent at every bed count
+        self.state_times = [0.0 for x in range(self.max_beds + 1)]
+        self.stamps = [self.time_stamps,
+                       self.stroke_patient_stamps,
+                       self.should_be_there_stamps,
+                       self.should_not_be_there_stamps,
+                       self.psc_stroke_stamps,
+                       self.csc_stroke_stamps,
+                       self.psc_non_stroke_stamps,
+                       self.csc_non_stroke_stamps]
+
+    # hospital the patients are sent on to, None if they are treated here
+    transfer_to = None
+
+    def config(self):
         '''
-        Departure is the same for every hospital
-        Decrement the bed count, add the time stamp for logging
+        The fixed description of this hospital, see HospitalConfig
         '''
-        self.bed_count -= 1
-        self.time_stamps.append((self.bed_count, departure_event.patient.completion_time))
-
-        patient_obj = departure_event.patient
-        if isinstance(patient_obj, Patient):
-            self.stroke_patient_count -= 1
-            if patient_obj.transfer_needed:
-                self.should_be_at_csc -= 1
-            else:
-                self.should_not_be_at_csc -= 1
-            
-            if patient_obj.from_psc:
-                self.stroke_from_psc -= 1
-            else:
-                self.stroke_from_csc -= 1
-        
-        else:
-            if patient_obj.from_psc:
-                self.non_stroke_from_psc -= 1
-            else:
-                self.non_stroke_from_csc -= 1
-
-        self.should_be_there_stamps.append((self.should_be_at_csc, departure_event.patient.completion_time))
-        self.should_not_be_there_stamps.append((self.should_not_be_at_csc, departure_event.patient.completion_time))
-        self.stroke_patient_stamps.append((self.stroke_patient_count, departure_event.patient.completion_time))
-
-        self.psc_stroke_stamps.append((self.stroke_from_psc, departure_event.patient.completion_time))
-        self.csc_stroke_stamps.append((self.stroke_from_csc, departure_event.patient.completion_time))
+        return HospitalConfig(type(self).__name__, self.pid, self.max_beds, self.transfer_rate,
+                              self.arrival_rate_stroke, self.arrival_rate_non_stroke,
+                              self.transfer_to, self.overflow_to)
 
-        self.psc_non_stroke_stamps.append((self.non_stroke_from_psc, departure_event.patient.completion_time))
-        self.csc_non_stroke_stamps.append((self.non_stroke_from_csc, departure_event.patient.completion_time))
-            
-        return False
-
-    def helper_TWA(self, time_stamp_array):
+    def arrivals(self, chunk_size = None, thin = False):
+        '''
+        Endless stream of the arrivals to this hospital, drawn lazily in chunks
+        With thin, only the arrivals that get sent on to transfer_to are kept
+        '''
+        return ArrivalSource(self, chunk_size, thin)
 
-        average = 0
-        # time weighted average
-        for i in range(len(time_stamp_array) - 1):
-            pair1 = time_stamp_array[i]
-            pair2 = time_stamp_array[i+1]
-            gap = pair2[1] - pair1[1]
-            time_slice = gap / DURATION
-            average += pair1[0] * time_slice
+    def transfer_probabilities(self):
+        '''
+        Probability that a patient of each kind (indexed by NON_STROKE / ISCHEMIC / HEMORRHAGIC)
+        is sent on to transfer_to
+        '''
+        return None
 
-        return average
+    def change_patient_counts(self, flags, delta, time):
+        '''
+        Admit (delta = 1) or discharge (delta = -1) a patient with the given flags
+        Every count it is part of changes, and the change is folded into the running averages
+        '''
+        counts = self.counts
+        areas = self.areas
+        last_change = self.last_change
+
+        self.state_times[counts[0]] += time - last_change[0]
+        group = COUNT_GROUPS[flags]
+        for i in group:
+            areas[i] += counts[i] * (time - last_change[i])
+            counts[i] += delta
+            last_change[i] = time
+        self.bed_count = counts[0]
+
+        if self.trace:
+            for i in group:
+                self.stamps[i].append((counts[i], time))
+        if self.recorder is not None:
+            self.recorder.record(time, self.pid, ADMISSION if delta > 0 else DISCHARGE, flags, counts[0])
+    
+    def snapshot(self, time):
+        '''
+        Running totals at a point in time (the last event has to be no later than time),
+        statistics over [time, end] are the totals at the end minus these
+        '''
+        areas = [area + count * (time - last) for area, count, last in zip(self.areas, self.counts, self.last_change)]
+        state_times = list(self.state_times)
+        state_times[self.counts[0]] += time - self.last_change[0]
+        return Snapshot(time, areas, state_times, self.arrival_count, self.rejected_count,
+                        self.should_be_rej, self.should_not_be_rej, self.overflow_count)
 
+    def discard_warmup(self, snapshot):
+        '''
+        Drop everything before a snapshot from the statistics:
+        the counters restart from it and the averages are taken from its time on
+        '''
+        self.arrival_count -= snapshot.arrival_count
+        self.rejected_count -= snapshot.rejected_count
+        self.should_be_rej -= snapshot.should_be_rej
+        self.should_not_be_rej -= snapshot.should_not_be_rej
+        self.overflow_count -= snapshot.overflow_count
+        self.warmup = snapshot
+
+    def process_departure(self, time, patient):
+        '''
+        Departure is the same for every hospital
+        Decrement the bed count and the counts for the kind of patient
+        '''
+        self.change_patient_counts(self.patients.flags[patient], -1, time)
+        self.patients.remove(patient)
+        return None
 
-    def calculate_average(self):
+    def calculate_average(self, end_time = None):
         '''
         Time Weighted Average (TWA) for bed counts for each hospital
+        Read off of the running averages, over [0, end_time] (by default the time the run stopped at,
+        which is before the duration when run_steady_state stopped early)
+        or from the end of the warm-up if it has been discarded
         '''
-
-        self.average_bed_count = self.helper_TWA(self.time_stamps)
-        self.average_should_be = self.helper_TWA(self.should_be_there_stamps)
-        self.average_should_not = self.helper_TWA(self.should_not_be_there_stamps)
-        self.average_stroke_count = self.helper_TWA(self.stroke_patient_stamps)
-
-        self.average_psc = self.helper_TWA(self.psc_stroke_stamps)
-        self.average_csc = self.helper_TWA(self.csc_stroke_stamps)
-
-        self.average_non_stroke_csc = self.helper_TWA(self.csc_non_stroke_stamps)
-        self.average_non_stroke_psc = self.helper_TWA(self.psc_non_stroke_stamps)
-
-        y_vals = [0 for x in range(self.max_beds + 1)]
-
-        for i in range(len(self.time_stamps) - 1):
-            pair1 = self.time_stamps[i]
-            pair2 = self.time_stamps[i+1]
-            gap = pair2[1] - pair1[1]
-            time_slice = gap / DURATION
-
-            y_vals[pair1[0]] += time_slice
-
-        self.hist_values = y_vals
+        if end_time is None:
+            end_time = self.stop_time()
+        start_time = 0.0
+        start_areas = [0.0 for name in COUNT_NAMES]
+        start_state_times = [0.0 for x in self.state_times]
+        if self.warmup is not None:
+            start_time, start_areas, start_state_times = self.warmup[:3]
+        length = end_time - start_time
+
+        for i, name in enumerate(AVERAGE_NAMES):
+            area = self.areas[i] + self.counts[i] * (end_time - self.last_change[i])
+            setattr(self, name, (area - start_areas[i]) / length)
+
+        state_times = list(self.state_times)
+        state_times[self.counts[0]] += end_time - self.last_change[0]
+        self.hist_values = [(x - start) / length for x, start in zip(state_times, start_state_times)]
+
+    def stop_time(self):
+        '''
+        The time the run stopped at, the duration if it has not been run by a Simulation
+        '''
+        return DURATION if self.end_time is None else self.end_time
 
     def pprint(self):
         '''
@@ -226,21 +430,34 @@ class Hospital:
         print("Average # of stroke patients that shouldn't be there: ", self.average_should_not)
         print("Percentage of stroke patients from CSC : ", self.average_csc / (self.average_psc + self.average_csc))
 
-    def graph_count(self):
+    def graph_count(self, points = None):
         '''
-        Plots the number of beds at each time stamp (event time step)
+        Plots the number of beds over time, downsampled to at most points points (LTTB)
+        so that it draws just as fast whatever the duration
+        Needs the occupancy over time: either the stamps (the simulation run with trace on)
+        or a TimelineRecorder as the recorder, then the mean and highest bed count of every interval are drawn
+        Raises ValueError when it has neither
         '''
+        timeline = isinstance(self.recorder, TimelineRecorder)
+        if not timeline and not self.trace:
+            raise ValueError("graph_count needs the occupancy over time: run the simulation with trace = True "
+                             "or with a TimelineRecorder as the recorder")
         self.calculate_average()
-        y_vals = [x[0] for x in self.time_stamps]
-        x_vals = [x[1] for x in self.time_stamps]
 
         plt.figure(figsize = (20, 5))
-        plt.plot(x_vals, y_vals, '--b')
+        if timeline:
+            edges, means, peaks = self.recorder.timeline(self.pid, self.stop_time())
+            plt.step(edges[:-1], means, '-b', where = 'post')
+            plt.step(edges[:-1], peaks, ':b', where = 'post')
+        else:
+            stamps = np.array(self.time_stamps, dtype = float).reshape(-1, 2)
+            x_vals, y_vals = lttb(*step_points(stamps[:, 1], stamps[:, 0], self.stop_time()), points)
+            plt.plot(x_vals, y_vals, '--b')
         plt.axhline(y = self.average_bed_count)
         plt.xlabel("Time Stamp")
         plt.ylabel("Number of Patients")
-        if self.pid == 0:
-            plt.title("Number of Patients over Time at CSC")
+        if isinstance(self, CSC):
+            plt.title("Number of Patients over Time at CSC #{}".format(self.pid))
         else:
             plt.title("Number of Patients over Time at PSC #{}".format(self.pid))
         plt.show()
@@ -248,7 +465,8 @@ class Hospital:
 
     def graph_distribution(self):
         '''
-        Plots the number of beds at each time stamp (event time step)
+        Plots the share of time spent at every bed count
+        Read off of the running state times, so it needs no stamps and has max_beds + 1 points at any duration
         '''
         self.calculate_average()
         x_vals = list(range(self.max_beds + 1))
@@ -269,29 +487,27 @@ class PSC(Hospital):
     Processes Arrivals Differently
     Think of the parent class as the standard for nodes
     '''
-    def process_arrival(self, arrival_event):
-        '''
-        If there are beds available at the hospital, process patient
-        If it is a stroke patient to be transfered, send along with time-to-transfer
+    # star model by default, every transfer goes to the CSC (hospital 0)
+    transfer_to = 0
 
-        If no beds available, ignore patient essentially (pretty bad)
+    def transfer_probabilities(self):
+        '''
+        Hemorrhagic strokes and non stroke patients are always sent along,
+        ischemic strokes at the transfer rate
         '''
-        patient = arrival_event.patient
+        return [1.0, self.transfer_rate, 1.0]
 
-        if isinstance(patient, Patient):
-            if patient.stroke_type == "HEMORRHAGIC":
-                arrival2_event = Event(patient, patient.spawn_time, "Arrival", 0)
-                return arrival2_event
-            
-            else:
-                if np.random.uniform() < self.transfer_rate:
-                    arrival2_event = Event(patient, patient.spawn_time, "Arrival", 0)
-                    return arrival2_event
-                return False
+    def process_arrival(self, time, patient):
+        '''
+        If it is a stroke patient to be transfered, send along to its CSC (transfer_to) right away
+        Ischemic strokes are only sent along at the transfer rate, otherwise they stay here
+        '''
+        if self.patients.kind[patient] == ISCHEMIC and self.streams[TRANSFER_COIN_STREAM].random() >= self.transfer_rate:
+            self.patients.remove(patient)
+            return None
 
-        elif isinstance(patient, NonStrokePatient):
-            arrival2_event = Event(patient, patient.spawn_time, "Arrival", 0)
-            return arrival2_event
+        # hemorrhagic strokes and non stroke patients are always sent along
+        return (time, TRANSFER, self.transfer_to)
 
 
 
@@ -300,92 +516,222 @@ class CSC(Hospital):
     Child class for the CSC
     Processes arrivals differently from PSC
     '''
-    def process_arrival(self, arrival_event):
+    def process_arrival(self, time, patient):
         '''
         Take in a patient
         If the bed count has been reached, reject and set the CSC to be full
-        if not, take in the patient and calculate a completion_time
+        if not, take in the patient and schedule its departure at its completion_time
+
+        A rejected patient that came here as its first choice is sent on to its overflow CSC
+        if it has one (it still counts as rejected here), otherwise it is lost
         '''
-        patient_obj = arrival_event.patient
+        patients = self.patients
+        flags = patients.flags[patient]
+        self.arrival_count += 1
 
-        if self.bed_count <= self.max_beds:
+        if self.bed_count < self.max_beds:
             # CSC_IS_FULL = False
-            self.bed_count += 1
-            departure_event = Event(patient_obj, patient_obj.completion_time, "Departure", self.pid)
-
-            if isinstance(patient_obj, Patient):
-                self.stroke_patient_count += 1
-                if patient_obj.transfer_needed:
-                    self.should_be_at_csc += 1
-                else:
-                    self.should_not_be_at_csc += 1
-                
-                if patient_obj.from_psc:
-                    self.stroke_from_psc += 1
-                else:
-                    self.stroke_from_csc += 1
-            
-            else:
-                if patient_obj.from_psc:
-                    self.non_stroke_from_psc += 1
-                else:
-                    self.non_stroke_from_csc += 1
-
-            return departure_event
+            self.change_patient_counts(flags, 1, time)
+            return (patients.completion_time[patient], DEPARTURE, self.pid)
 
         # CSC_IS_FULL = True
         self.rejected_count += 1
-        if isinstance(patient_obj, Patient):
-            if patient_obj.transfer_needed:
+        if flags & STROKE_FLAG:
+            if flags & TRANSFER_NEEDED_FLAG:
                 self.should_be_rej += 1
             else:
                 self.should_not_be_rej += 1
+        origin = patients.origin[patient]
+        routing = self.routing
+        if routing.overflow[origin] != NO_HOSPITAL and routing.primary[origin] == self.pid:
+            self.overflow_count += 1
+            if self.recorder is not None:
+                self.recorder.record(time, self.pid, OVERFLOW, flags, self.bed_count)
+            return (time, TRANSFER, routing.overflow[origin])
+
+        if self.recorder is not None:
+            self.recorder.record(time, self.pid, REJECTION, flags, self.bed_count)
+        patients.remove(patient)
+
+        return None
 
-        return False
 
 
+# Columnar batch of arrivals to a single hospital, one entry per patient
+# kind holds the NON_STROKE / ISCHEMIC / HEMORRHAGIC codes, flags the *_FLAG bits
+PatientBatch = namedtuple('PatientBatch', ['times', 'kind', 'flags', 'duration'])
 
-def arrival_spawner(list_of_hospitals):
+
+def spawn_patients(hospital, start_time, size):
+    '''
+    Draw the next `size` arrivals to a single hospital after start_time as whole arrays
+
+    The non stroke and stroke streams are superposed into a single poisson stream
+    (cumsum of exponential gaps) and each arrival is a stroke patient with probability
+    arrival_rate_stroke / total rate. Stroke patients get the hemorrhagic coin flip,
+    a duration that depends on it and the transfer_needed flag (always true for
+    hemorrhagic strokes) via masked draws
     '''
-    This is just a star model so the CSC is at the center and it is fed by multiple hospitals
-    We model the arrival rates to the hospital as the sum of the exit rates from the PSCs
+    total_rate = hospital.arrival_rate_stroke + hospital.arrival_rate_non_stroke
+
+    streams = hospital.streams
+    times = start_time + np.cumsum(streams[ARRIVAL_STREAM].exponential(1.0 / total_rate, size))
+    stroke = streams[PATIENT_TYPE_STREAM].uniform(size = size) * total_rate < hospital.arrival_rate_stroke
+    hemorrhagic = stroke & (streams[PATIENT_TYPE_STREAM].uniform(size = size) < HEMORRHAGIC_PERCENTAGE)
+    needed = streams[TRANSFER_NEEDED_STREAM].uniform(size = size) < TRANSFER_NEEDED_PERCENTAGE
+    transfer_needed = hemorrhagic | (stroke & needed)
+
+    kind = np.where(stroke, np.where(hemorrhagic, HEMORRHAGIC, ISCHEMIC), NON_STROKE)
+    flags = STROKE_FLAG * stroke + TRANSFER_NEEDED_FLAG * transfer_needed
+    if not isinstance(hospital, CSC):
+        flags += FROM_PSC_FLAG
+    scale = np.where(stroke, np.where(hemorrhagic, HEMORRHAGIC_RATE, ISCHEMIC_RATE), NON_STROKE_PATIENT_DURATION)
+    duration = streams[LENGTH_OF_STAY_STREAM].exponential(scale)
 
-    This discrete event simulation is an abstraction - we first generate all of the possible
-    entities in the system into a big queue as the composition of the separate PSCs
+    return PatientBatch(times, kind, flags, duration)
 
-    We then build up this queue to pull from later in the hospital
+
+class ArrivalSource:
+    '''
+    Iterator over the arrivals to a single hospital, in time order
+    Each arrival is added to the hospital's PatientTable and its index is handed back
+
+    Only one chunk of ARRIVAL_CHUNK_SIZE columnar draws is kept alive at a time,
+    so the memory does not depend on the duration of the simulation. Without a chunk_size,
+    a quiet hospital (one that expects less than a chunk of arrivals over ARRIVAL_CHUNK_DAYS)
+    draws chunks of only about what it expects over those days (at least MIN_ARRIVAL_CHUNK_SIZE),
+    so hundreds of quiet PSCs cost little to set up and to hold
+    The chunk size only depends on the arrival rate, never on the duration, so a run from a seed
+    is the start of any longer run from the same seed
+
+    With thin, every chunk is thinned by the hospital's transfer_probabilities as it is drawn,
+    which leaves exactly the (still poisson) stream of patients that get sent on
+    '''
+    def __init__(self, hospital, chunk_size = None, thin = False):
+        self.hospital = hospital
+        self.rate = hospital.arrival_rate_stroke + hospital.arrival_rate_non_stroke
+        self.chunk_size = chunk_size
+        if chunk_size is None:
+            expected = int(self.rate * ARRIVAL_CHUNK_DAYS)
+            self.chunk_size = min(ARRIVAL_CHUNK_SIZE, max(MIN_ARRIVAL_CHUNK_SIZE, expected))
+        self.keep = None
+        if thin:
+            self.keep = np.array(hospital.transfer_probabilities())
+
+        self.empty = self.rate <= 0
+        if self.keep is not None and not self.keep.any():
+            self.empty = True
+
+        self.batch = None
+        self.batch_size = 0
+        self.position = 0
+        self.last_time = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.empty:
+            raise StopIteration
+        return self.pop()
+
+    def pop(self):
+        '''
+        Next arrival, without the StopIteration check (the source must not be empty)
+        '''
+        while self.position == self.batch_size:
+            size = self.chunk_size
+            batch = spawn_patients(self.hospital, self.last_time, size)
+            self.last_time = float(batch.times[-1])
+            if self.keep is not None:
+                coins = self.hospital.streams[TRANSFER_COIN_STREAM].random(size)
+                kept = coins < self.keep[batch.kind]
+                batch = PatientBatch(*[column[kept] for column in batch])
+
+            # plain lists, single elements come out of them much faster than out of numpy
+            self.batch = PatientBatch(*[column.tolist() for column in batch])
+            self.batch_size = len(self.batch.times)
+            self.position = 0
+
+        batch = self.batch
+        i = self.position
+        self.position += 1
+        hospital = self.hospital
+        hospital.number_spawned += 1
+        return hospital.patients.add(batch.times[i], batch.duration[i], batch.kind[i], batch.flags[i], hospital.pid)
+
+
+class RandomStreams:
+    '''
+    Dedicated random generators keyed by (hospital id, purpose), all derived from one SeedSequence
+    For common random numbers: every random decision of a given kind at a given hospital comes
+    from its own stream, so runs from the same seed see the same underlying randomness
+    even when a parameter change makes them use a different number of draws elsewhere
     '''
+    def __init__(self, seed_sequence):
+        self.seed_sequence = seed_sequence
+        self.generators = {}
 
-    spawning_queue = []
-    number_spawned = 0
+    def get(self, hospital_id, purpose):
+        '''
+        The generator for one hospital and purpose, the same one every time it is asked for
+        '''
+        key = (hospital_id, purpose)
+        if key not in self.generators:
+            seed_sequence = self.seed_sequence
+            child = np.random.SeedSequence(seed_sequence.entropy,
+                                           spawn_key = tuple(seed_sequence.spawn_key) + key,
+                                           pool_size = seed_sequence.pool_size)
+            self.generators[key] = np.random.default_rng(child)
+        return self.generators[key]
 
-    for hospital in list_of_hospitals:
-        # spawn the arrivals to the hospital of non stroke patients
-        current_time = 0
-        while current_time < 2*DURATION:
-            current_time += np.random.exponential(1.0 / hospital.arrival_rate_non_stroke)
-            if isinstance(hospital, CSC):
-                new_patient = NonStrokePatient(number_spawned, current_time, False)
-            else:
-                new_patient = NonStrokePatient(number_spawned, current_time, True)
 
-            new_event = Event(new_patient, current_time, "Arrival", hospital.pid)
-            spawning_queue.append(new_event)
-            number_spawned += 1
-        
-        current_time = 0
-        while current_time < 2*DURATION:
-            current_time += np.random.exponential(1.0 / hospital.arrival_rate_stroke) 
-            if isinstance(hospital, CSC):
-                new_patient = Patient(number_spawned, current_time, False)
-            else:
-                new_patient = Patient(number_spawned, current_time, True)
+# the Hospital class for every HospitalConfig kind
+HOSPITAL_TYPES = {'CSC': CSC, 'PSC': PSC}
+
+NO_HOSPITAL = -1
 
-            new_event = Event(new_patient, current_time, "Arrival", hospital.pid)
-            spawning_queue.append(new_event)
-            number_spawned += 1
+# Where the patients arriving at each hospital go, as arrays indexed by hospital id:
+# primary is the hospital that treats them (the hospital itself for a CSC, transfer_to for a PSC)
+# overflow is the CSC they are sent to when the primary is full, or NO_HOSPITAL
+Routing = namedtuple('Routing', ['primary', 'overflow'])
 
-    return spawning_queue
+
+def network_routing(hospitals):
+    '''
+    The Routing of a list of hospitals (indexed by id)
+    Raises ValueError if a route leads to a hospital without beds, or overflows back where it started
+    '''
+    primary = array('i')
+    overflow = array('i')
+    for hid, hospital in enumerate(hospitals):
+        target = hid if hospital.transfer_to is None else hospital.transfer_to
+        spill = NO_HOSPITAL if hospital.overflow_to is None else hospital.overflow_to
+        for route in [target, spill]:
+            if route != NO_HOSPITAL and not (0 <= route < len(hospitals) and isinstance(hospitals[route], CSC)):
+                raise ValueError("Hospital {} routes its patients to hospital {}, which is not a CSC".format(hid, route))
+        if spill == target:
+            raise ValueError("Hospital {} overflows to the CSC it sends its patients to".format(hid))
+        primary.append(target)
+        overflow.append(spill)
+    return Routing(primary, overflow)
+
+
+def build_hospitals(hospital_configs, trace = False):
+    '''
+    Fresh Hospital objects for a list of HospitalConfigs
+    PSCs without a transfer_to send their patients to the first CSC
+    '''
+    first_csc = next((hospital.pid for hospital in hospital_configs if hospital.kind == 'CSC'), None)
+    hospitals = []
+    for hospital in hospital_configs:
+        transfer_to = hospital.transfer_to
+        if transfer_to is None and hospital.kind == 'PSC':
+            transfer_to = first_csc
+        hospitals.append(HOSPITAL_TYPES[hospital.kind](hospital.pid, hospital.max_beds, hospital.transfer_rate,
+                                                       hospital.arrival_rate_stroke, hospital.arrival_rate_non_stroke,
+                                                       trace, transfer_to, hospital.overflow_to))
+    return hospitals
 
 
 def build_hospital_dict(list_of_hospitals):
@@ -397,18 +743,164 @@ def build_hospital_dict(list_of_hospitals):
         hdict[hospital.pid] = hospital
     return hdict
 
+class Instrumentation:
+    '''
+    Counters and timers filled in by a Simulation run with instrument = True
+    phases: wall time spent setting up, popping / pushing the heap, in the hospital handlers,
+    drawing arrivals and post processing. events: [hospital id][event code] counts
+    samples: (seconds into the run, events per second since the previous sample) every sample_interval seconds
+    '''
+    def __init__(self, number_of_hospitals, sample_interval = 1.0):
+        self.phases = {'setup': 0.0, 'heap': 0.0, 'handlers': 0.0, 'arrivals': 0.0, 'post_processing': 0.0}
+        self.events = [[0 for name in EVENT_NAMES] for hid in range(number_of_hospitals)]
+        self.heap_high_water = 0
+        self.run_seconds = 0.0
+        self.sample_interval = sample_interval
+        self.samples = []
+
+    def event_count(self):
+        return sum(sum(counts) for counts in self.events)
+
+    def report(self):
+        '''
+        Everything as a dict, ready to be written out as json
+        '''
+        total = self.event_count()
+        return {
+            'phases': dict(self.phases),
+            'events': {name: sum(counts[code] for counts in self.events) for code, name in enumerate(EVENT_NAMES)},
+            'hospitals': [dict(zip(EVENT_NAMES, counts)) for counts in self.events],
+            'heap_high_water': self.heap_high_water,
+            'run_seconds': self.run_seconds,
+            'events_per_second': total / self.run_seconds if self.run_seconds else 0.0,
+            'samples': self.samples,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent = 2)
+
+    def text_report(self, max_hospitals = 10):
+        '''
+        Readable summary, the per hospital counts are only listed for the busiest max_hospitals
+        '''
+        report = self.report()
+        lines = ["---------------------------------------------------",
+                 "Events: {}  ({:.0f} events/s over {:.3f}s)".format(
+                     sum(report['events'].values()), report['events_per_second'], report['run_seconds']),
+                 "Heap high water mark: {}".format(report['heap_high_water']),
+                 "---------------------------------------------------"]
+        for name, seconds in report['phases'].items():
+            lines.append("{0:16s} {1:10.4f}s".format(name, seconds))
+        lines.append("---------------------------------------------------")
+        lines.append("Hospital   " + "".join("{0:>12s}".format(name) for name in EVENT_NAMES))
+        busiest = sorted(range(len(self.events)), key = lambda hid: -sum(self.events[hid]))[:max_hospitals]
+        for hid in sorted(busiest):
+            lines.append("{0:<11d}".format(hid) + "".join("{0:12d}".format(count) for count in self.events[hid]))
+        if len(self.events) > max_hospitals:
+            lines.append("... {} quieter hospitals left out".format(len(self.events) - max_hospitals))
+        lines.append("---------------------------------------------------")
+        return "\n".join(lines)
+
+
 class Simulation:
     '''
     Parent class for Simulation
+    rng is a numpy Generator to draw from, defaults to the global np.random state
+    streams (a RandomStreams) gives every hospital its own generator per purpose instead,
+    for common random numbers across runs
+    trace switches on the full (count, time) stamp lists on every hospital
+
+    The hospital IDs have to be 0 .. number of hospitals - 1, they index the
+    handler table: handlers[hospital id][event code] processes that event, and the routing arrays
+    (see Routing) that send the patients of every hospital to their CSC and on to an overflow CSC.
+    An event costs O(log pending events) whatever the number of hospitals: the queue holds
+    at most one pending arrival per hospital plus one departure per occupied bed.
+    Events are (time, sequence number, event code, hospital id, patient) tuples,
+    the sequence number breaks ties between events at the same time in the order they were scheduled
+
+    With compile_topology (the default) the transfers are worked out when the arrivals are drawn:
+    the stream of a hospital that sends its patients on is thinned to the ones that get sent,
+    and its arrivals are handled by the receiving hospital right away, so they never pass
+    through the queue twice. Any other zero delay transfer is also handed straight to
+    the receiving hospital instead of going through the queue
+
+    instrument switches on an Instrumentation (in self.instrumentation) that times
+    and counts what the event loop does, at some cost to its speed
+
+    reset puts the simulation back to time 0 for another replication on the same hospitals,
+    only the per replication state is rebuilt
+
+    recorder (a TraceRecorder) streams every admission, discharge and rejection to disk,
+    closing it is up to the caller
+
+    event_list picks the event list backend out of event_lists.EVENT_LISTS: 'heap' (binary heap),
+    'calendar' (calendar queue, O(1) per event for very large queues) or 'merge' (arrivals and
+    the other events in separate heaps). They all hand out the events in the same order
     '''
-    def __init__(self, sid, hospital_dict, verbose = False):
+    def __init__(self, sid, hospital_dict, verbose = False, rng = None, trace = False, compile_topology = True,
+                 streams = None, instrument = False, recorder = None, event_list = 'heap'):
+        setup_start = time.perf_counter()
         self.sid = sid
         self.hospital_dict = hospital_dict
-        self.event_queue = arrival_spawner(hospital_list)
-        heapq.heapify(self.event_queue)
+        if sorted(hospital_dict) != list(range(len(hospital_dict))):
+            raise ValueError("Hospital IDs have to run from 0 to {}".format(len(hospital_dict) - 1))
+
+        self.hospitals = [hospital_dict[hid] for hid in range(len(hospital_dict))]
+        self.trace = trace
+        self.compile_topology = compile_topology
+        self.verbose = verbose
+        self.instrument = instrument
+        self.recorder = recorder
+        if event_list not in EVENT_LISTS:
+            raise ValueError("Unknown event list {}, use one of {}".format(event_list, sorted(EVENT_LISTS)))
+        # MergeEventList tells the arrivals apart by their code, it has to be this module's
+        assert ARRIVAL == ARRIVAL_CODE, "event_lists.ARRIVAL_CODE has to match ARRIVAL"
+        self.event_list = event_list
+        self.reset(rng, streams)
+        if instrument:
+            self.instrumentation.phases['setup'] += time.perf_counter() - setup_start
+
+    def reset(self, rng = None, streams = None):
+        '''
+        Back to time 0 with empty hospitals, drawing from rng (or streams) from now on
+        Costs O(number of hospitals), nothing about the network is copied or rebuilt
+        '''
+        self.rng = rng if rng is not None else np.random
+        self.random_streams = streams
+        self.patients = PatientTable()
+        self.routing = network_routing(self.hospitals)
+        for hid, hospital in enumerate(self.hospitals):
+            hospital.reset()
+            if streams is None:
+                hospital.streams = [self.rng for name in STREAM_NAMES]
+            else:
+                hospital.streams = [streams.get(hid, purpose) for purpose in range(len(STREAM_NAMES))]
+            hospital.patients = self.patients
+            hospital.trace = self.trace
+            hospital.recorder = self.recorder
+            hospital.routing = self.routing
+
+        self.handlers = []
+        self.sources = []
+        for hospital in self.hospitals:
+            compiled = self.compile_topology and hospital.transfer_to is not None
+            arrival_handler = hospital.process_arrival
+            if compiled:
+                arrival_handler = self.hospitals[hospital.transfer_to].process_arrival
+            self.handlers.append((arrival_handler, hospital.process_arrival, hospital.process_departure))
+            self.sources.append(hospital.arrivals(thin = compiled))
+        self.sequence = itertools.count()
+
+        # k-way merge of the arrival streams, at most one pending arrival per hospital
+        self.event_queue = EVENT_LISTS[self.event_list]()
+        for hid in range(len(self.hospitals)):
+            self.schedule_arrival(hid)
         self.current_time = 0
+        self.events_processed = 0
         self.duration = DURATION
-        self.verbose = False
+        self.warmup_time = 0.0
+        self.instrumentation = Instrumentation(len(self.hospitals)) if self.instrument else None
 
     def set_verbose(self, verbosity):
         '''
@@ -420,125 +912,662 @@ class Simulation:
         '''
         getter helper
         '''
-        return self.hospital_dict[hid]
+        return self.hospitals[hid]
+
+    def schedule(self, time, code, hospital_id, patient):
+        '''
+        Put an event on the queue
+        '''
+        self.event_queue.push((time, next(self.sequence), code, hospital_id, patient))
+
+    def schedule_arrival(self, hospital_id):
+        '''
+        Pull the next arrival off of a hospital's source and put it on the queue
+        '''
+        patient = next(self.sources[hospital_id], None)
+        if patient is not None:
+            self.schedule(self.patients.spawn_time[patient], ARRIVAL, hospital_id, patient)
 
     def get_next_event(self):
         '''
         Getter to pop off the queue
         '''
         if self.event_queue:
-            return heapq.heappop(self.event_queue)
+            return self.event_queue.pop()
         else:
             return False
 
     def process_event(self, event):
         '''
-        process either event
+        process a single event, run_simulation does the same thing inline
         '''
-        temp_hospital = self.get_hospital(event.hospital_id)
-        
-        if event.event_type == "Arrival":
-            if self.verbose:
-                event.pprint()
+        time, sequence, code, hospital_id, patient = event
+        if time < self.current_time:
+            raise Exception("Events out of order on event type {}".format(EVENT_NAMES[code]))
+        self.current_time = time
 
-            new_event = temp_hospital.process_arrival(event)
+        if self.verbose:
+            print(format_event(event))
 
-        elif event.event_type == "Departure":
-            if self.verbose:
-                event.pprint()
-                
-            new_event = temp_hospital.process_departure(event)
-        
-        if new_event:
-            heapq.heappush(self.event_queue, new_event)
+        new_event = self.handlers[hospital_id][code](time, patient)
+        while new_event is not None and new_event[1] == TRANSFER and new_event[0] == time:
+            new_event = self.handlers[new_event[2]][TRANSFER](time, patient)
+        if new_event is not None:
+            self.schedule(new_event[0], new_event[1], new_event[2], patient)
 
-        if event.completion_time >= self.current_time:
-            self.current_time = event.completion_time
-        else:
-            raise Exception("Events out of order on event type {}".format(event.event_type))
-        
-        return
+        if code == ARRIVAL:
+            self.schedule_arrival(hospital_id)
 
-    def run_simulation(self):
+    def advance(self, max_events = None):
+        '''
+        Process events until the duration is reached or max_events have been processed
+        This is the hot loop, everything it touches is pulled into locals
+        Returns the number of events processed
+        '''
+        if self.instrumentation is not None:
+            return self.advance_instrumented(max_events)
+
+        queue = self.event_queue
+        handlers = self.handlers
+        # only sources that have had an arrival on the queue come up again, so none of them are empty
+        next_arrival = [source.pop for source in self.sources]
+        spawn_time = self.patients.spawn_time
+        sequence = self.sequence
+        duration = self.duration
+        verbose = self.verbose
+        push = queue.push
+        pop = queue.pop
+
+        time = self.current_time
+        events = 0
+        limit = -1 if max_events is None else max_events
+        while queue and events != limit:
+            event = pop()
+            if event[0] >= duration:
+                # past the end, it waits on the queue for the next advance
+                push(event)
+                break
+            events += 1
+            time, seq, code, hospital_id, patient = event
+            if verbose:
+                print(format_event(event))
+
+            new_event = handlers[hospital_id][code](time, patient)
+            if new_event is not None:
+                # zero delay transfers go straight to the receiving hospital
+                while new_event is not None and new_event[1] == TRANSFER and new_event[0] == time:
+                    new_event = handlers[new_event[2]][TRANSFER](time, patient)
+                if new_event is not None:
+                    push((new_event[0], next(sequence), new_event[1], new_event[2], patient))
+
+            if code == ARRIVAL:
+                next_patient = next_arrival[hospital_id]()
+                push((spawn_time[next_patient], next(sequence), ARRIVAL, hospital_id, next_patient))
+
+        self.current_time = time
+        self.events_processed += events
+        return events
+
+    def advance_instrumented(self, max_events = None):
+        '''
+        advance, with every step timed and counted into self.instrumentation
+        '''
+        stats = self.instrumentation
+        phases = stats.phases
+        counts = stats.events
+        queue = self.event_queue
+        handlers = self.handlers
+        next_arrival = [source.pop for source in self.sources]
+        spawn_time = self.patients.spawn_time
+        sequence = self.sequence
+        duration = self.duration
+        verbose = self.verbose
+        push = queue.push
+        pop = queue.pop
+        clock = time.perf_counter
+
+        heap_time = handler_time = arrival_time = 0.0
+        high_water = stats.heap_high_water
+        start = last_sample = clock()
+        last_sample_events = 0
+        now = self.current_time
+        events = 0
+        limit = -1 if max_events is None else max_events
+        while queue and events != limit:
+            t0 = clock()
+            event = pop()
+            t1 = clock()
+            if event[0] >= duration:
+                push(event)
+                heap_time += clock() - t0
+                break
+            events += 1
+            now, seq, code, hospital_id, patient = event
+            counts[hospital_id][code] += 1
+            if verbose:
+                print(format_event(event))
+
+            new_event = handlers[hospital_id][code](now, patient)
+            while new_event is not None and new_event[1] == TRANSFER and new_event[0] == now:
+                counts[new_event[2]][TRANSFER] += 1
+                new_event = handlers[new_event[2]][TRANSFER](now, patient)
+            t2 = clock()
+            if new_event is not None:
+                push((new_event[0], next(sequence), new_event[1], new_event[2], patient))
+            t3 = t4 = clock()
+            if code == ARRIVAL:
+                next_patient = next_arrival[hospital_id]()
+                t4 = clock()
+                push((spawn_time[next_patient], next(sequence), ARRIVAL, hospital_id, next_patient))
+            t5 = clock()
+
+            heap_time += (t1 - t0) + (t3 - t2) + (t5 - t4)
+            handler_time += t2 - t1
+            arrival_time += t4 - t3
+            if len(queue) > high_water:
+                high_water = len(queue)
+            if events % SAMPLE_EVENTS == 0 and t5 - last_sample >= stats.sample_interval:
+                stats.samples.append((stats.run_seconds + t5 - start, (events - last_sample_events) / (t5 - last_sample)))
+                last_sample = t5
+                last_sample_events = events
+
+        phases['heap'] += heap_time
+        phases['handlers'] += handler_time
+        phases['arrivals'] += arrival_time
+        stats.heap_high_water = high_water
+        stats.run_seconds += clock() - start
+
+        self.current_time = now
+        self.events_processed += events
+        return events
+
+    def finished(self):
+        '''
+        True once every event before the end of the simulation has been processed
+        '''
+        first = self.event_queue.peek()
+        return first is None or first[0] >= self.duration
+
+    def run_simulation(self, checkpoint_path = None, checkpoint_every = None, checkpoint_seconds = None):
         '''
         run it baby
+        Picks up where it left off, so it also finishes a restored simulation
+
+        With a checkpoint_path the state is saved there every checkpoint_every events
+        and / or every checkpoint_seconds of wall time, and once more at the end
         '''
-        self.current_time = 0
-        while self.current_time < self.duration:
-            next_event = heapq.heappop(self.event_queue)
-            self.process_event(next_event)
+        if checkpoint_path is None or (checkpoint_every is None and checkpoint_seconds is None):
+            self.advance()
+        else:
+            segment = checkpoint_every or CHECKPOINT_SEGMENT
+            last_checkpoint = time.time()
+            since_checkpoint = 0
+            while not self.finished():
+                since_checkpoint += self.advance(segment)
+                due_events = checkpoint_every is not None and since_checkpoint >= checkpoint_every
+                due_seconds = checkpoint_seconds is not None and time.time() - last_checkpoint >= checkpoint_seconds
+                if due_events or due_seconds:
+                    self.checkpoint(checkpoint_path)
+                    last_checkpoint = time.time()
+                    since_checkpoint = 0
+
+        if checkpoint_path is not None:
+            self.checkpoint(checkpoint_path)
+
+        self.current_time = self.duration
+        for hospital in self.hospitals:
+            hospital.end_time = self.duration
+
+    def run_steady_state(self, interval = None, steady_time = None, batch_size = None):
+        '''
+        Run from the start while observing the total occupancy every interval days,
+        then find the end of the warm-up with MSER on those observations and discard
+        everything before it from the statistics of every hospital
+
+        With steady_time the run ends early, at the first batch boundary where
+        the warm-up found so far is followed by at least steady_time days
+        Returns the truncation time
+        '''
+        if interval is None:
+            interval = WARMUP_INTERVAL
+        if batch_size is None:
+            batch_size = MSER_BATCH_SIZE
+
+        end_time = self.duration
+        boundary = self.current_time
+        snapshots = [[hospital.snapshot(boundary) for hospital in self.hospitals]]
+        occupancy = []
+        # kept for batch_metrics
+        self.snapshots = snapshots
+        self.occupancy = occupancy
+        while boundary < end_time:
+            boundary = min(boundary + interval, end_time)
+            self.duration = boundary
+            self.advance()
+            snapshots.append([hospital.snapshot(boundary) for hospital in self.hospitals])
+
+            start, end = snapshots[-2], snapshots[-1]
+            occupied = sum(after.areas[0] - before.areas[0] for before, after in zip(start, end))
+            occupancy.append(occupied / (end[0].time - start[0].time))
+
+            if steady_time is not None and len(occupancy) % batch_size == 0:
+                truncation = mser(occupancy, batch_size)
+                if boundary - snapshots[truncation][0].time >= steady_time:
+                    break
+
+        truncation = mser(occupancy, batch_size)
+        for hospital, snapshot in zip(self.hospitals, snapshots[truncation]):
+            hospital.discard_warmup(snapshot)
+        self.truncation = truncation
+        self.warmup_time = snapshots[truncation][0].time
+        self.duration = boundary
+        self.current_time = boundary
+        for hospital in self.hospitals:
+            hospital.end_time = boundary
+        return self.warmup_time
+
+    def batch_metrics(self, batch_size = None, min_batches = None):
+        '''
+        Split the part of a run_steady_state run after the warm-up into non overlapping batches
+        of batch_size observation intervals, and give the CSC metrics of every batch
+        (in the form of replication_metrics, so they can go wherever replications go)
+
+        By default the batch size is picked from the lag-1 autocorrelation of the occupancy,
+        see choose_batch_size. Intervals left over at the end are dropped
+        '''
+        if min_batches is None:
+            min_batches = MIN_BATCHES
+        observations = self.occupancy[self.truncation:]
+        if batch_size is None:
+            batch_size = choose_batch_size(observations, min_batches)
+
+        csc = [hid for hid, hospital in enumerate(self.hospitals) if isinstance(hospital, CSC)][0]
+        snapshots = [snapshot[csc] for snapshot in self.snapshots[self.truncation:]]
+        return [window_metrics(snapshots[start], snapshots[start + batch_size])
+                for start in range(0, len(observations) - batch_size + 1, batch_size)]
+
+    def checkpoint(self, path):
+        '''
+        Save the full state of the simulation (event queue, patients, hospital counters and
+        running averages, arrival sources, random generator state, clock) to a single .npz file
+        The file is written next to path first and then moved over it, so a kill mid-write
+        leaves the previous checkpoint intact
+        '''
+        # next value of the sequence counter, without skipping it
+        next_sequence = next(self.sequence)
+        self.sequence = itertools.count(next_sequence)
+
+        meta = {
+            'sid': self.sid,
+            'current_time': self.current_time,
+            'duration': self.duration,
+            'events_processed': self.events_processed,
+            'warmup_time': self.warmup_time,
+            'next_sequence': next_sequence,
+            'trace': self.trace,
+            'compile_topology': self.compile_topology,
+            'event_list': self.event_list,
+            'constants': {name: globals()[name] for name in CHECKPOINT_CONSTANTS},
+            'rng': get_rng_state(self.rng),
+            'streams': None,
+            'hospitals': [],
+            'sources': [],
+        }
+
+        if self.random_streams is not None:
+            meta['streams'] = [[get_rng_state(stream) for stream in hospital.streams] for hospital in self.hospitals]
+
+        queue = list(self.event_queue)
+        arrays = {
+            'queue_time': np.array([event[0] for event in queue], dtype = np.float64),
+            'queue_sequence': np.array([event[1] for event in queue], dtype = np.int64),
+            'queue_code': np.array([event[2] for event in queue], dtype = np.int8),
+            'queue_hospital': np.array([event[3] for event in queue], dtype = np.int32),
+            'queue_patient': np.array([event[4] for event in queue], dtype = np.int64),
+            'patients_spawn_time': np.frombuffer(self.patients.spawn_time, dtype = np.float64),
+            'patients_completion_time': np.frombuffer(self.patients.completion_time, dtype = np.float64),
+            'patients_kind': np.frombuffer(self.patients.kind, dtype = np.int8),
+            'patients_flags': np.frombuffer(self.patients.flags, dtype = np.int8),
+            'patients_origin': np.frombuffer(self.patients.origin, dtype = np.int32),
+            'patients_free': np.array(self.patients.free, dtype = np.int64),
+        }
+
+        for hid, hospital in enumerate(self.hospitals):
+            meta['hospitals'].append({
+                'config': hospital.config()._asdict(),
+                'number_spawned': hospital.number_spawned,
+                'rejected_count': hospital.rejected_count,
+                'arrival_count': hospital.arrival_count,
+                'should_be_rej': hospital.should_be_rej,
+                'should_not_be_rej': hospital.should_not_be_rej,
+                'overflow_count': hospital.overflow_count,
+            })
+            arrays['hospital{}_counts'.format(hid)] = np.array(hospital.counts, dtype = np.int64)
+            arrays['hospital{}_areas'.format(hid)] = np.array(hospital.areas)
+            arrays['hospital{}_last_change'.format(hid)] = np.array(hospital.last_change)
+            arrays['hospital{}_state_times'.format(hid)] = np.array(hospital.state_times)
+            if hospital.warmup is not None:
+                meta['hospitals'][-1]['warmup'] = hospital.warmup._asdict()
+            if self.trace:
+                for i, stamps in enumerate(hospital.stamps):
+                    arrays['hospital{}_stamps{}'.format(hid, i)] = np.array(stamps, dtype = np.float64).reshape(-1, 2)
+
+        for hid, source in enumerate(self.sources):
+            meta['sources'].append({
+                'position': source.position,
+                'batch_size': source.batch_size,
+                'last_time': source.last_time,
+            })
+            if source.batch is not None:
+                for name, column in zip(PatientBatch._fields, source.batch):
+                    arrays['source{}_{}'.format(hid, name)] = np.array(column)
+
+        arrays['meta'] = np.array(json.dumps(meta))
+
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as checkpoint_file:
+            np.savez(checkpoint_file, **arrays)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def restore(cls, path, verbose = False):
+        '''
+        Rebuild a simulation from a checkpoint, run_simulation carries on exactly where it stopped
+        The module constants are set from the checkpoint as well
+        '''
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        meta = json.loads(str(arrays['meta']))
+
+        for name, value in meta['constants'].items():
+            globals()[name] = value
+
+        hospital_list = build_hospitals([HospitalConfig(**saved['config']) for saved in meta['hospitals']])
+
+        rng = set_rng_state(meta['rng'])
+        streams = None
+        if meta['streams'] is not None:
+            # the seed does not matter, every stream is put back to its saved state below
+            streams = RandomStreams(np.random.SeedSequence(0))
+        simulation = cls(meta['sid'], build_hospital_dict(hospital_list), verbose = verbose, rng = rng,
+                         trace = meta['trace'], compile_topology = meta['compile_topology'], streams = streams,
+                         event_list = meta.get('event_list', 'heap'))
+        # building the simulation drew from the generators, put them back where the checkpoint left them
+        set_rng_state(meta['rng'], rng)
+        if streams is not None:
+            for hospital, saved_streams in zip(simulation.hospitals, meta['streams']):
+                for stream, saved in zip(hospital.streams, saved_streams):
+                    set_rng_state(saved, stream)
+
+        simulation.current_time = meta['current_time']
+        simulation.duration = meta['duration']
+        simulation.events_processed = meta['events_processed']
+        simulation.warmup_time = meta['warmup_time']
+        simulation.sequence = itertools.count(meta['next_sequence'])
+
+        patients = simulation.patients
+        patients.spawn_time = array('d', arrays['patients_spawn_time'].tobytes())
+        patients.completion_time = array('d', arrays['patients_completion_time'].tobytes())
+        patients.kind = array('b', arrays['patients_kind'].tobytes())
+        patients.flags = array('b', arrays['patients_flags'].tobytes())
+        patients.origin = array('i', arrays['patients_origin'].tobytes())
+        patients.free = arrays['patients_free'].tolist()
+
+        events = zip(arrays['queue_time'].tolist(),
+                     arrays['queue_sequence'].tolist(),
+                     arrays['queue_code'].tolist(),
+                     arrays['queue_hospital'].tolist(),
+                     arrays['queue_patient'].tolist())
+        simulation.event_queue = EVENT_LISTS[simulation.event_list](events)
+
+        for hid, (hospital, saved) in enumerate(zip(simulation.hospitals, meta['hospitals'])):
+            for name in ['number_spawned', 'rejected_count', 'arrival_count', 'should_be_rej', 'should_not_be_rej',
+                         'overflow_count']:
+                setattr(hospital, name, saved[name])
+            if 'warmup' in saved:
+                hospital.warmup = Snapshot(**saved['warmup'])
+            hospital.counts = arrays['hospital{}_counts'.format(hid)].tolist()
+            hospital.areas = arrays['hospital{}_areas'.format(hid)].tolist()
+            hospital.last_change = arrays['hospital{}_last_change'.format(hid)].tolist()
+            hospital.state_times = arrays['hospital{}_state_times'.format(hid)].tolist()
+            hospital.bed_count = hospital.counts[0]
+            if simulation.trace:
+                for i, stamps in enumerate(hospital.stamps):
+                    saved_stamps = arrays['hospital{}_stamps{}'.format(hid, i)]
+                    stamps[:] = [(int(count), stamp_time) for count, stamp_time in saved_stamps.tolist()]
+
+        for hid, (source, saved) in enumerate(zip(simulation.sources, meta['sources'])):
+            source.position = saved['position']
+            source.batch_size = saved['batch_size']
+            source.last_time = saved['last_time']
+            source.batch = None
+            if 'source{}_times'.format(hid) in arrays:
+                source.batch = PatientBatch(*[arrays['source{}_{}'.format(hid, name)].tolist()
+                                              for name in PatientBatch._fields])
+
+        return simulation
+
+
+# Module constants the simulation depends on, saved with every checkpoint
+CHECKPOINT_CONSTANTS = [
+    'ISCHEMIC_RATE',
+    'HEMORRHAGIC_RATE',
+    'NON_STROKE_PATIENT_DURATION',
+    'TRANSFER_NEEDED_PERCENTAGE',
+    'HEMORRHAGIC_PERCENTAGE',
+    'DURATION',
+    'ARRIVAL_CHUNK_SIZE',
+    'MIN_ARRIVAL_CHUNK_SIZE',
+    'ARRIVAL_CHUNK_DAYS'
+]
+
+
+def get_rng_state(rng):
+    '''
+    JSON friendly state of a numpy Generator, or of the global np.random state
+    '''
+    if isinstance(rng, np.random.Generator):
+        return {'generator': True, 'state': rng.bit_generator.state}
+
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    return {'generator': False, 'state': [name, keys.tolist(), position, has_gauss, cached_gaussian]}
+
+
+def set_rng_state(saved, rng = None):
+    '''
+    Put a random generator back into a state from get_rng_state
+    Builds a new Generator (or hands back np.random) when rng is not given
+    '''
+    if not saved['generator']:
+        name, keys, position, has_gauss, cached_gaussian = saved['state']
+        np.random.set_state((name, np.array(keys, dtype = np.uint32), position, has_gauss, cached_gaussian))
+        return np.random
+
+    if rng is None:
+        bit_generator = getattr(np.random, saved['state']['bit_generator'])()
+        rng = np.random.Generator(bit_generator)
+    rng.bit_generator.state = saved['state']
+    return rng
+
+
+# Hospital attributes that make up the compact per-replication result
+METRIC_ATTRIBUTES = [
+    'arrival_count',
+    'rejected_count',
+    'should_be_rej',
+    'should_not_be_rej',
+    'average_bed_count',
+    'average_stroke_count',
+    'average_should_be',
+    'average_should_not',
+    'average_csc',
+    'average_psc',
+    'average_non_stroke_csc',
+    'average_non_stroke_psc',
+    'hist_values'
+]
+
+STATISTIC_NAMES = [
+    "Number Rejected",
+    "Number of Stroke Patients Rejected who should be there",
+    "Number of Stroke Patients Rejected who should not be there",
+    "Percentage of Stroke Patients who were rejected that should have been transferred",
+    "Average # of beds filled",
+    "Average Stroke Patient Count",
+    "Average # of stroke patients that should be there",
+    "Average # of stroke patients that shouldn't be there",
+    "Average Percentage of Stroke Patients from CSC",
+    "Average Percentage of Non-stroke Patients from CSC",
+    "Overall Blocking Probability"
+]
+
+
+def replication_metrics(simulation):
+    '''
+    Compact summary of a finished simulation (the counters and averages of the first CSC,
+    see network_metrics for all of them)
+    This is all that needs to be kept / sent back from a worker process
+    '''
+    start = time.perf_counter()
+    for hospital in simulation.hospital_dict.values():
+        if isinstance(hospital, CSC):
+            hospital.calculate_average(simulation.duration)
+            metrics = {name: getattr(hospital, name) for name in METRIC_ATTRIBUTES}
+            metrics['hist_values'] = list(metrics['hist_values'])
+            if simulation.instrumentation is not None:
+                simulation.instrumentation.phases['post_processing'] += time.perf_counter() - start
+            return metrics
+
+
+def network_metrics(simulation):
+    '''
+    Per node version of replication_metrics: the metrics of every CSC of a finished simulation,
+    each with its pid and overflow_count as well
+    '''
+    list_of_metrics = []
+    for hospital in simulation.hospitals:
+        if isinstance(hospital, CSC):
+            hospital.calculate_average(simulation.duration)
+            metrics = {name: getattr(hospital, name) for name in METRIC_ATTRIBUTES + ['pid', 'overflow_count']}
+            metrics['hist_values'] = list(metrics['hist_values'])
+            list_of_metrics.append(metrics)
+    return list_of_metrics
+
+
+def window_metrics(start, end):
+    '''
+    Metrics of a hospital over the time between two of its snapshots,
+    in the same form as replication_metrics (with the overflow_count over the window as well)
+    '''
+    length = end.time - start.time
+    metrics = {}
+    for name in ['arrival_count', 'rejected_count', 'should_be_rej', 'should_not_be_rej', 'overflow_count']:
+        metrics[name] = getattr(end, name) - getattr(start, name)
+    for i, name in enumerate(AVERAGE_NAMES):
+        metrics[name] = (end.areas[i] - start.areas[i]) / length
+    metrics['hist_values'] = [(after - before) / length for before, after in zip(start.state_times, end.state_times)]
+    return {name: metrics[name] for name in METRIC_ATTRIBUTES + ['overflow_count']}
+
+
+def average_metrics(list_of_metrics):
+    '''
+    Average each metric (elementwise for the histogram) over the replications
+    '''
+    simulation_num = len(list_of_metrics)
+    averaged = {}
+    for name in METRIC_ATTRIBUTES:
+        if name == 'hist_values':
+            total = [0 for x in list_of_metrics[0][name]]
+            for metrics in list_of_metrics:
+                total = list(map(add, total, metrics[name]))
+            averaged[name] = [x / simulation_num for x in total]
+        else:
+            averaged[name] = sum(metrics[name] for metrics in list_of_metrics) / simulation_num
+    return averaged
+
+
+def summary_statistics(metrics):
+    '''
+    The reported statistics (in the order of STATISTIC_NAMES) for a set of metrics,
+    either a single replication or the average of many
+    '''
+    rej_should = metrics['should_be_rej']
+    rej_should_not = metrics['should_not_be_rej']
+    csc_stroke = metrics['average_csc']
+    psc_stroke = metrics['average_psc']
+    csc_nonstroke = metrics['average_non_stroke_csc']
+    psc_nonstroke = metrics['average_non_stroke_psc']
+
+    def percentage(part, whole):
+        return 100 * part / whole if whole else float('nan')
+
+    return [metrics['rejected_count'],
+            rej_should,
+            rej_should_not,
+            percentage(rej_should, rej_should + rej_should_not),
+            metrics['average_bed_count'],
+            metrics['average_stroke_count'],
+            metrics['average_should_be'],
+            metrics['average_should_not'],
+            percentage(csc_stroke, csc_stroke + psc_stroke),
+            percentage(csc_nonstroke, csc_nonstroke + psc_nonstroke),
+            100 * metrics['hist_values'][-1]]
+
+
+def statistic_estimates(list_of_metrics, confidence = 0.95):
+    '''
+    Mean and confidence interval of every statistic in STATISTIC_NAMES across replications
+    '''
+    samples = np.array([summary_statistics(metrics) for metrics in list_of_metrics], dtype = float)
+    return [confidence_interval(samples[:, column], confidence) for column in range(len(STATISTIC_NAMES))]
+
+
+def print_estimates(estimates, confidence = 0.95):
+    print("---------------------------------------------------")
+    print("########## {0:.0f}% Confidence Intervals ({1} samples) ##########".format(100 * confidence, estimates[0].n))
+    print("---------------------------------------------------")
+    for name, estimate in zip(STATISTIC_NAMES, estimates):
+        print("{0}: {1:.3f} +- {2:.3f}".format(name, estimate.mean, estimate.half_width))
+    print("---------------------------------------------------")
 
 
 def combine_simulations(list_of_simulations, plot = False, toCSV = False):
     '''
     average results from the simulation somehow
     '''
-    simulation_num = len(list_of_simulations)
-
-    avg_rej = 0
-    avg_rej_should = 0
-    avg_rej_should_not = 0
-    avg_number_beds_filled = 0
-    avg_stroke_patient_count = 0
-    avg_should = 0
-    avg_should_not = 0
-    avg_CSC_stroke = 0
-    avg_PSC_stroke = 0
-    avg_CSC_nonstroke = 0
-    avg_PSC_nonstroke = 0
-    avg_hist = [0 for x in range(number_beds_ICU + 1)]
-
-    for simulation in list_of_simulations:
-        for hospital in simulation.hospital_dict.values():
-            if isinstance(hospital, CSC):
-                hospital.calculate_average()
-                avg_rej += hospital.rejected_count
-                avg_rej_should += hospital.should_be_rej
-                avg_rej_should_not += hospital.should_not_be_rej
-                avg_number_beds_filled += hospital.average_bed_count
-                avg_stroke_patient_count += hospital.average_stroke_count
-                avg_should += hospital.average_should_be
-                avg_should_not += hospital.average_should_not
-                avg_CSC_stroke += hospital.average_csc
-                avg_PSC_stroke += hospital.average_psc
-                avg_CSC_nonstroke += hospital.average_non_stroke_csc
-                avg_PSC_nonstroke += hospital.average_non_stroke_psc
-                avg_hist = list(map(add, avg_hist, hospital.hist_values))
-    
-    avg_rej /= simulation_num
-    avg_rej_should /= simulation_num
-    avg_rej_should_not /= simulation_num
-    avg_number_beds_filled /= simulation_num
-    avg_stroke_patient_count /= simulation_num
-    avg_should /= simulation_num
-    avg_should_not /= simulation_num
-    avg_CSC_stroke /= simulation_num
-    avg_PSC_stroke /= simulation_num
-    avg_CSC_nonstroke /= simulation_num
-    avg_PSC_nonstroke /= simulation_num
-    avg_hist = [x / simulation_num for x in avg_hist]
+    list_of_metrics = [replication_metrics(simulation) for simulation in list_of_simulations]
+    return combine_metrics(list_of_metrics, plot, toCSV)
+
+
+def combine_metrics(list_of_metrics, plot = False, toCSV = False):
+    '''
+    average the per-replication metrics (see replication_metrics) and report them
+    '''
+    averaged = average_metrics(list_of_metrics)
+    values = summary_statistics(averaged)
+    avg_hist = averaged['hist_values']
 
     print("---------------------------------------------------")
     print("################ Averaged Results #################")
     print("---------------------------------------------------")
-    print("Number Rejected: ", avg_rej)
-    print("Number of Stroke Patients Rejected who should be there: ", avg_rej_should)
-    print("Number of Stroke Patients Rejected who should not be there: ", avg_rej_should_not)
+    print("Number Rejected: ", values[0])
+    print("Number of Stroke Patients Rejected who should be there: ", values[1])
+    print("Number of Stroke Patients Rejected who should not be there: ", values[2])
     print("Percentage of Stroke Patients who were REJECTED \n \
-        that should have been transferred {0:4.2f}%".format(100 * avg_rej_should / (avg_rej_should + avg_rej_should_not)))
-    print("Average Number of beds filled: {0:4.2f}".format(avg_number_beds_filled))
-    print("Average Stroke Patient Count: {0:4.2f}".format(avg_stroke_patient_count))
-    print("Average # of stroke patients that should be there: {0:4.2f}".format(avg_should))
-    print("Average # of stroke patients that shouldn't be there: {0:4.2f}".format(avg_should_not))
-    print("Average Percentage of Stroke Patients from CSC: {0:4.2f}%".format(100 * avg_CSC_stroke / (avg_CSC_stroke + avg_PSC_stroke)))
-    print("Average Percentage of Non-Stroke Patients from CSC: {0:4.2f}%".format(100 * avg_CSC_nonstroke / (avg_CSC_nonstroke + avg_PSC_nonstroke)))
-    print("Overall Blocking Probability: {0:4.2f}%".format(100 * avg_hist[-1]))
+        that should have been transferred {0:4.2f}%".format(values[3]))
+    print("Average Number of beds filled: {0:4.2f}".format(values[4]))
+    print("Average Stroke Patient Count: {0:4.2f}".format(values[5]))
+    print("Average # of stroke patients that should be there: {0:4.2f}".format(values[6]))
+    print("Average # of stroke patients that shouldn't be there: {0:4.2f}".format(values[7]))
+    print("Average Percentage of Stroke Patients from CSC: {0:4.2f}%".format(values[8]))
+    print("Average Percentage of Non-Stroke Patients from CSC: {0:4.2f}%".format(values[9]))
+    print("Overall Blocking Probability: {0:4.2f}%".format(values[10]))
     # print("Blocking Probability for stroke patients who should be transferred: {}".format(-1))
     print("---------------------------------------------------")
 
     if plot:
 
-        x_vals = list(range(number_beds_ICU + 1))
+        x_vals = list(range(len(avg_hist)))
         
         plt.figure(figsize = (20, 5))
         plt.plot(x_vals, avg_hist, '-o')
@@ -548,154 +1577,575 @@ def combine_simulations(list_of_simulations, plot = False, toCSV = False):
         plt.show()
 
     if toCSV:
-        values = [avg_rej, 
-                avg_rej_should, 
-                avg_rej_should_not, 
-                (100* avg_rej_should / (avg_rej_should + avg_rej_should_not)), 
-                avg_number_beds_filled,
-                avg_stroke_patient_count,
-                avg_should,
-                avg_should_not,
-                100 * avg_CSC_stroke / (avg_CSC_stroke + avg_PSC_stroke),
-                100 * avg_CSC_nonstroke / (avg_CSC_nonstroke + avg_PSC_nonstroke),
-                100 * avg_hist[-1]]
-
-        names = [
-            "Number Rejected",
-            "Number of Stroke Patients Rejected who should be there",
-            "Number of Stroke Patients Rejected who should not be there",
-            "Percentage of Stroke Patients who were rejected that should have been transferred",
-            "Average # of beds filled",
-            "Average Stroke Patient Count",
-            "Average # of stroke patients that should be there",
-            "Average # of stroke patients that shouldn't be there",
-            "Average Percentage of Stroke Patients from CSC",
-            "Average Percentage of Non-stroke Patients from CSC",
-            "Overall Blocking Probability"
-        ]
-
-        d = {'Statistics': names, 'Values': values}
+        d = {'Statistics': STATISTIC_NAMES, 'Values': values}
         new_data_frame = pd.DataFrame(d)
         new_data_frame.to_csv("test.csv", index = False)
 
     return avg_hist[-1]
 
 
-def all_entries_empty(list_strings):
-    return not list(filter(lambda x: x, list_strings))
+def combine_network(list_of_network_metrics):
+    '''
+    average the per node metrics of every CSC (see network_metrics) over the replications and report them
+    A patient is lost once it is rejected without an overflow CSC to go to, the network loss
+    probability is the share of the patients reaching the CSCs that are lost
+    Returns the network loss probability (in %)
+    '''
+    print("---------------------------------------------------")
+    print("################ Averaged Network Results #################")
+    print("---------------------------------------------------")
+    print("{0:>6s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>10s}".format(
+        "CSC", "Arrivals", "Rejected", "Overflow", "Beds", "Blocking"))
+
+    arrivals = lost = 0.0
+    for nodes in zip(*list_of_network_metrics):
+        averaged = average_metrics(nodes)
+        overflow = sum(node['overflow_count'] for node in nodes) / len(nodes)
+        print("{0:>6d} {1:10.1f} {2:10.1f} {3:10.1f} {4:10.2f} {5:9.2f}%".format(
+            nodes[0]['pid'], averaged['arrival_count'], averaged['rejected_count'], overflow,
+            averaged['average_bed_count'], 100 * averaged['hist_values'][-1]))
+        # an overflowed patient arrives twice, but is only lost once
+        arrivals += averaged['arrival_count'] - overflow
+        lost += averaged['rejected_count'] - overflow
+
+    loss = 100 * lost / arrivals if arrivals else float('nan')
+    print("---------------------------------------------------")
+    print("Network Loss Probability: {0:4.2f}%".format(loss))
+    print("---------------------------------------------------")
+    return loss
 
-if __name__ == "__main__":
-    
-    hospital_list = []
 
-    print("Reading the Config File...")
-    with open('hospitals_demo.csv', 'r', encoding='utf-8-sig') as csvfile:
-        readCSV = csv.reader(csvfile, delimiter=',')
-        rows = [row for row in readCSV]
-        i = 0
-        while 'Parameters' not in rows[i]:
-            i += 1
-        i += 1
-        ISCHEMIC_RATE = float(rows[i][1])
-        HEMORRHAGIC_RATE = float(rows[i+1][1])
-        NON_STROKE_PATIENT_DURATION = float(rows[i+2][1])
-        TRANSFER_NEEDED_PERCENTAGE = float(rows[i+3][1])
-        DURATION = float(rows[i+4][1])
-        NUMBER_OF_SIMULATIONS = int(rows[i+5][1])
-        i += 1
-        while 'CSC Configuration:' not in rows[i]:
-            i += 1
-            # advance while we still have 
-        if 'CSC Configuration:' in rows[i]:
-            i += 1
-            while 'PSC Configuration:' not in rows[i]:
-                if not all_entries_empty(rows[i]):
-                    # print(rows[i])
-                    hospital_index = 0
-                    hospital_name = rows[i][1]
-                    number_beds_ICU = int(rows[i][2])
-                    #-------------------------------------#
-                    # arrival_rate_stroke = float(rows[i][3])
-                    arrival_rate_stroke = float(rows[i][3])
-                    arrival_rate_non_stroke = float(rows[i][4])
-
-                    hospital_list.append(CSC(hospital_index, 
-                                            number_beds_ICU,
-                                            0.0,
-                                            arrival_rate_stroke,
-                                            arrival_rate_non_stroke))
-                i += 1
-            i += 1
-            while i < len(rows):
-                if not all_entries_empty(rows[i]):
-                    hospital_index += 1
-                    hospital_name = rows[i][1]
-                    hospital_transfer_rate = float(rows[i][2])
-                    arrival_rate_stroke = float(rows[i][3])
-                    arrival_rate_non_stroke = float(rows[i][4])
-                    hospital_list.append(PSC(hospital_index,
-                                            0,
-                                            hospital_transfer_rate,
-                                            arrival_rate_stroke,
-                                            arrival_rate_non_stroke))
-                i += 1
-        else:
-            print("Something wrong with the config file, please reset back to base state")
-            # exit
-    print("     -> Finished Reading the Config File!\n")
+def apply_config(config):
+    '''
+    Set the module constants from a config
+    Needed in every worker process before it can build simulations
+    '''
+    global ISCHEMIC_RATE, HEMORRHAGIC_RATE, NON_STROKE_PATIENT_DURATION
+    global TRANSFER_NEEDED_PERCENTAGE, DURATION, NUMBER_OF_SIMULATIONS
 
-    blocking_probabilities = []
+    ISCHEMIC_RATE = config.ischemic_rate
+    HEMORRHAGIC_RATE = config.hemorrhagic_rate
+    NON_STROKE_PATIENT_DURATION = config.non_stroke_duration
+    TRANSFER_NEEDED_PERCENTAGE = config.transfer_needed_percentage
+    DURATION = config.duration
+    NUMBER_OF_SIMULATIONS = config.number_of_simulations
 
-    many_times = False
-    upper_bound = 1
-    if many_times:
-        upper_bound = 101
-    
-    save_output = True
 
-    for rate in range(0, upper_bound):
+def run_replication(config, sid, seed_sequence, common_random_numbers = False, warmup = False, steady_time = None,
+                    nodes = False):
+    '''
+    Build and run a single replication on its own random stream
+    (or with common_random_numbers, on streams keyed by hospital and purpose)
+    With warmup the warm-up is detected and left out of the statistics, see Simulation.run_steady_state
+    Returns only the compact metrics, not the Simulation (with nodes, those of every CSC, see network_metrics)
+    '''
+    apply_config(config)
+    hospital_dict = build_hospital_dict(build_hospitals(config.hospitals))
+    streams = RandomStreams(seed_sequence) if common_random_numbers else None
+    simulation = Simulation(sid, hospital_dict, rng = np.random.default_rng(seed_sequence), streams = streams)
+    if warmup:
+        simulation.run_steady_state(steady_time = steady_time)
+    else:
+        simulation.run_simulation()
+    if nodes:
+        return network_metrics(simulation)
+    return replication_metrics(simulation)
+
+
+def replication_key(config, seed_sequence, common_random_numbers = False, warmup = False, steady_time = None,
+                    nodes = False):
+    '''
+    Cache key of a single replication, a hash of everything its result depends on
+    '''
+    hospitals = [hospital._asdict() for hospital in config.hospitals]
+
+    return fingerprint({
+        'engine_version': ENGINE_VERSION,
+        'config': {name: getattr(config, name) for name in Config._fields
+                   if name not in ['hospitals', 'number_of_simulations']},
+        'hospitals': hospitals,
+        'constants': [HEMORRHAGIC_PERCENTAGE, ARRIVAL_CHUNK_SIZE, MIN_ARRIVAL_CHUNK_SIZE, ARRIVAL_CHUNK_DAYS, WARMUP_INTERVAL,
+                      MSER_BATCH_SIZE],
+        'seed': [str(seed_sequence.entropy), list(seed_sequence.spawn_key), seed_sequence.pool_size],
+        'options': [common_random_numbers, warmup, steady_time, nodes],
+    })
+
+
+def run_tasks(executor, configs, sids, seed_sequences, cache = None,
+              common_random_numbers = False, warmup = False, steady_time = None, nodes = False):
+    '''
+    Run a list of replications on an executor (or right here if it is None)
+    With a cache (a ResultCache) the replications already in it are not run again,
+    and the new ones are added to it
+    Returns the metrics in task order
+    '''
+    results = [None for sid in sids]
+    keys = [None for sid in sids]
+    if cache is not None:
+        keys = [replication_key(config, seed_sequence, common_random_numbers, warmup, steady_time, nodes)
+                for config, seed_sequence in zip(configs, seed_sequences)]
+        results = [cache.get(key) for key in keys]
+
+    missing = [i for i, metrics in enumerate(results) if metrics is None]
+    arguments = [[configs[i] for i in missing],
+                 [sids[i] for i in missing],
+                 [seed_sequences[i] for i in missing],
+                 [common_random_numbers] * len(missing),
+                 [warmup] * len(missing),
+                 [steady_time] * len(missing),
+                 [nodes] * len(missing)]
+    run = map if executor is None else executor.map
+    for i, metrics in zip(missing, run(run_replication, *arguments)):
+        results[i] = metrics
+        if cache is not None:
+            cache.put(keys[i], metrics)
+    return results
+
+
+def run_replications(config, n, workers = None, seed = None, warmup = False, steady_time = None, cache = None,
+                     nodes = False):
+    '''
+    Run n independent replications of a config over a pool of worker processes
+    warmup, steady_time and nodes are passed on to run_replication, with a cache
+    only the replications that are not in it yet are run
 
-        if many_times:
-            print("############# TRANSFER RATE = {} #############".format(rate))
-            for hospital in hospital_list:
-                if isinstance(hospital, PSC):
-                    hospital.transfer_rate = rate / 100
+    Replication i always draws from the i-th child of SeedSequence(seed), so for
+    a fixed seed the results are identical whatever the number of workers.
+    Returns the list of per-replication metrics, in replication order
+    '''
+    seed_sequences = np.random.SeedSequence(seed).spawn(n)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, n)
 
-        
-        print("Building the simulations...\n")
-
-        hospital_dict = build_hospital_dict(hospital_list)
-        simulations = []
-        for i in range(NUMBER_OF_SIMULATIONS):
-            print("Starting Simulation # {}...".format(i + 1))
-            my_hospital_dict = copy.deepcopy(hospital_dict)
-            mySimulation = Simulation(i, my_hospital_dict)
-            # mySimulation.set_verbose(True)
-            mySimulation.run_simulation()
-            for hospital in my_hospital_dict.values():
-                # print(hospital.pid)
-                if isinstance(hospital, CSC):
-                    pass
-                    # hospital.pprint()
-
-            simulations.append(mySimulation)
-            print("     -> Finished Simulation # {}!\n".format(i + 1))
-
-        blocking_probabilities.append(100 * combine_simulations(simulations, plot = True, toCSV = save_output))
-
-    # print(blocking_probabilities)
-    if many_times:
+    if workers <= 1:
+        return run_tasks(None, [config] * n, list(range(n)), seed_sequences, cache, False, warmup, steady_time, nodes)
 
-        plt.figure(figsize = (20, 5))
-        nums = [x/100 for x in range(len(blocking_probabilities))]
-        # plt.xticks(nums)
-        plt.plot(nums, blocking_probabilities, '-o')
-        plt.ylabel("% of Patients blocked by full ICU")
-        plt.xlabel("Transfer Rate of Stroke Patients")
-        # plt.xlabel("")
-
-        # if filename:
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        return run_tasks(executor, [config] * n, list(range(n)), seed_sequences, cache, False, warmup, steady_time,
+                         nodes)
+
+
+# Outcome of run_until_precision, estimates line up with STATISTIC_NAMES
+SequentialResult = namedtuple('SequentialResult', ['metrics', 'estimates', 'converged'])
+
+
+def run_until_precision(config, target_half_width, statistic = "Overall Blocking Probability",
+                        confidence = 0.95, min_replications = 10, max_replications = 1000,
+                        workers = None, seed = None, cache = None):
+    '''
+    Keep running replications until the confidence interval of one statistic
+    (in the units summary_statistics reports, so percentage points for the percentages)
+    has a half width of at most target_half_width, or max_replications have been run
+
+    Replications are launched a round at a time (min_replications first, then one per worker)
+    and the precision is checked after every round. Replication i draws from the i-th child
+    of SeedSequence(seed), the same as in run_replications
+    '''
+    column = STATISTIC_NAMES.index(statistic)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    root_seed = np.random.SeedSequence(seed)
+    min_replications = max(2, min(min_replications, max_replications))
+
+    def run_round(executor, start, count):
+        return run_tasks(executor, [config] * count, list(range(start, start + count)), root_seed.spawn(count), cache)
+
+    executor = ProcessPoolExecutor(max_workers = workers) if workers > 1 else None
+    try:
+        list_of_metrics = run_round(executor, 0, min_replications)
+        while True:
+            estimates = statistic_estimates(list_of_metrics, confidence)
+            converged = estimates[column].half_width <= target_half_width
+            if converged or len(list_of_metrics) >= max_replications:
+                break
+            count = min(max(workers, 1), max_replications - len(list_of_metrics))
+            list_of_metrics += run_round(executor, len(list_of_metrics), count)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return SequentialResult(list_of_metrics, estimates, converged)
+
+
+# Outcome of run_batch_means, metrics holds one entry per batch and estimates line up with STATISTIC_NAMES
+BatchMeansResult = namedtuple('BatchMeansResult', ['metrics', 'estimates', 'batch_size', 'warmup_time'])
+
+
+def run_batch_means(config, seed = None, interval = None, batch_size = None, min_batches = None, confidence = 0.95):
+    '''
+    One long run instead of many replications: the warm-up is detected and dropped,
+    and the rest of the run is split into batches that stand in for the replications
+    batch_size is in observation intervals (interval days each), picked automatically by default
+    '''
+    apply_config(config)
+    hospital_dict = build_hospital_dict(build_hospitals(config.hospitals))
+    simulation = Simulation(0, hospital_dict, rng = np.random.default_rng(np.random.SeedSequence(seed)))
+    simulation.run_steady_state(interval)
+    if batch_size is None:
+        batch_size = choose_batch_size(simulation.occupancy[simulation.truncation:], min_batches or MIN_BATCHES)
+    list_of_metrics = simulation.batch_metrics(batch_size)
+
+    return BatchMeansResult(list_of_metrics, statistic_estimates(list_of_metrics, confidence),
+                            batch_size, simulation.warmup_time)
+
+
+# Hospital attributes that can be swept, and the kind of hospital they are set on
+# anything else has to be a Config field
+HOSPITAL_SWEEP_PARAMETERS = {
+    'transfer_rate': 'PSC',
+    'max_beds': 'CSC',
+}
+
+# A finished sweep point, metrics is the list of per-replication metrics
+SweepPoint = namedtuple('SweepPoint', ['value', 'metrics'])
+
+
+def sweep_config(config, param, value):
+    '''
+    A copy of config with param set to value
+    '''
+    if param in Config._fields:
+        return config._replace(**{param: value})
+
+    if param not in HOSPITAL_SWEEP_PARAMETERS:
+        raise ValueError("Can not sweep over parameter {}".format(param))
+
+    kind = HOSPITAL_SWEEP_PARAMETERS[param]
+    hospitals = tuple(hospital._replace(**{param: value}) if hospital.kind == kind else hospital
+                      for hospital in config.hospitals)
+    return config._replace(hospitals = hospitals)
+
+
+def sweep(config, param = "transfer_rate", values = None, n = None, workers = None, seed = None,
+          common_random_numbers = False, cache = None):
+    '''
+    Run n replications at every value of a parameter, spread over a process pool
+    as (sweep point x replication) tasks
+
+    Generator: a SweepPoint is yielded as soon as all of its replications are done,
+    so the points come back in the order they finish, not the order of values.
+    Each point gets its own child of SeedSequence(seed), split again per replication
+
+    With common_random_numbers, replication k uses the same seed at every point and draws
+    from per hospital / per purpose streams, so differences between points can be
+    estimated from paired replications (see paired_differences)
+
+    With a cache the replications already in it are not run again. Point p always gets
+    the same seeds, so a sweep widened by adding values at the end only runs the new points
+    '''
+    if values is None:
+        values = [x / 100 for x in range(0, 101)]
+    if n is None:
+        n = config.number_of_simulations
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    point_configs = [sweep_config(config, param, value) for value in values]
+    if common_random_numbers:
+        point_seeds = [np.random.SeedSequence(seed).spawn(n)] * len(values)
+    else:
+        point_seeds = [point_seed.spawn(n) for point_seed in np.random.SeedSequence(seed).spawn(len(values))]
+
+    if workers <= 1:
+        for p, value in enumerate(values):
+            metrics = run_tasks(None, [point_configs[p]] * n, list(range(n)), point_seeds[p], cache,
+                                common_random_numbers)
+            yield SweepPoint(value, metrics)
+        return
+
+    keys = [[None] * n for value in values]
+    results = [[None] * n for value in values]
+    if cache is not None:
+        for p in range(len(values)):
+            keys[p] = [replication_key(point_configs[p], point_seeds[p][k], common_random_numbers) for k in range(n)]
+            results[p] = [cache.get(key) for key in keys[p]]
+    remaining = [sum(metrics is None for metrics in results[p]) for p in range(len(values))]
+
+    for p in range(len(values)):
+        if remaining[p] == 0:
+            yield SweepPoint(values[p], results[p])
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = {}
+        for p in range(len(values)):
+            for k in range(n):
+                if results[p][k] is None:
+                    future = executor.submit(run_replication, point_configs[p], k, point_seeds[p][k],
+                                             common_random_numbers)
+                    futures[future] = (p, k)
+
+        for future in as_completed(futures):
+            p, k = futures[future]
+            results[p][k] = future.result()
+            if cache is not None:
+                cache.put(keys[p][k], results[p][k])
+            remaining[p] -= 1
+            if remaining[p] == 0:
+                yield SweepPoint(values[p], results[p])
+                results[p] = None
+
+
+def blocking_curve(sweep_points):
+    '''
+    Sorted (values, blocking percentages) out of a list of SweepPoints
+    '''
+    points = sorted(sweep_points, key = lambda point: point.value)
+    values = [point.value for point in points]
+    blocking = [100 * average_metrics(point.metrics)['hist_values'][-1] for point in points]
+    return values, blocking
+
+
+# Estimated change in a statistic going from one sweep value to the next
+PointDifference = namedtuple('PointDifference', ['from_value', 'to_value', 'estimate'])
+
+
+def paired_differences(sweep_points, statistic = "Overall Blocking Probability", confidence = 0.95):
+    '''
+    Difference in a statistic (one of STATISTIC_NAMES) between consecutive sweep values,
+    paired replication by replication. Only meaningful for a common_random_numbers sweep,
+    where replication k of every point ran on the same random numbers
+    '''
+    column = STATISTIC_NAMES.index(statistic)
+    points = sorted(sweep_points, key = lambda point: point.value)
+    samples = [[summary_statistics(metrics)[column] for metrics in point.metrics] for point in points]
+
+    differences = []
+    for p in range(1, len(points)):
+        estimate = paired_difference(samples[p - 1], samples[p], confidence)
+        differences.append(PointDifference(points[p - 1].value, points[p].value, estimate))
+    return differences
+
+
+def plot_blocking_curve(values, blocking, filename = ''):
+    '''
+    Plot the blocking probability against the swept transfer rate
+    '''
+    plt.figure(figsize = (20, 5))
+    plt.plot(values, blocking, '-o')
+    plt.ylabel("% of Patients blocked by full ICU")
+    plt.xlabel("Transfer Rate of Stroke Patients")
+
+    if filename:
         print("Saving file...")
-        plt.savefig("large_simulation_output.png")
+        plt.savefig(filename)
 
-        plt.show()
+    plt.show()
+
+
+def replication_timeline(config, sid, seed_sequence, interval = None, hospital = None):
+    '''
+    Run a single replication (on the same random stream as run_replication) with a TimelineRecorder
+    Returns the mean bed count of every interval at one hospital (the first CSC by default)
+    '''
+    apply_config(config)
+    hospitals = build_hospitals(config.hospitals)
+    if hospital is None:
+        hospital = [csc.pid for csc in hospitals if isinstance(csc, CSC)][0]
+    recorder = TimelineRecorder(config.duration, interval)
+    simulation = Simulation(sid, build_hospital_dict(hospitals), rng = np.random.default_rng(seed_sequence),
+                            recorder = recorder)
+    simulation.run_simulation()
+    return recorder.timeline(hospital, simulation.duration)[1]
+
+
+# Occupancy over time across replications: series has one row per replication of the mean
+# bed count in every interval between the edges, bands one row per percentile
+OccupancyBands = namedtuple('OccupancyBands', ['edges', 'percentiles', 'bands', 'series'])
+
+
+def occupancy_bands(config, n = None, interval = None, hospital = None, percentiles = None, workers = None, seed = None):
+    '''
+    Percentile bands (p5 / p50 / p95 by default) of the occupancy of one hospital over time,
+    from n replications (the config's number of simulations by default) over a pool of worker processes
+    Replication i is the same one as in run_replications with the same seed
+    '''
+    if n is None:
+        n = config.number_of_simulations
+    if percentiles is None:
+        percentiles = list(BAND_PERCENTILES)
+    seed_sequences = np.random.SeedSequence(seed).spawn(n)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, n)
+
+    arguments = [[config] * n, list(range(n)), seed_sequences, [interval] * n, [hospital] * n]
+    if workers <= 1:
+        series = list(map(replication_timeline, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            series = list(executor.map(replication_timeline, *arguments))
+
+    series = np.array(series)
+    return OccupancyBands(interval_edges(config.duration, interval), percentiles,
+                          percentile_bands(series, percentiles), series)
+
+
+def plot_occupancy_bands(bands, filename = ''):
+    '''
+    Plot the median occupancy over time with the outer percentiles shaded around it
+    '''
+    # the last value is repeated at the end so that the last interval is drawn as well
+    edges = bands.edges
+    values = np.concatenate([bands.bands, bands.bands[:, -1:]], axis = 1)
+    middle = len(bands.percentiles) // 2
+
+    plt.figure(figsize = (20, 5))
+    plt.fill_between(edges, values[0], values[-1], step = 'post', alpha = 0.3,
+                     label = "p{} - p{}".format(bands.percentiles[0], bands.percentiles[-1]))
+    plt.step(edges, values[middle], '-b', where = 'post', label = "p{}".format(bands.percentiles[middle]))
+    plt.xlabel("Time")
+    plt.ylabel("Number of Patients")
+    plt.title("Number of Patients over Time ({} replications)".format(len(bands.series)))
+    plt.legend()
+
+    if filename:
+        print("Saving file...")
+        plt.savefig(filename)
+
+    plt.show()
+
+
+def config_offered_load(config):
+    '''
+    Offered load at the CSC (the mean number of beds that would be filled with no limit):
+    every stream of patients that ends up there times its mean length of stay
+    Erlang-B only depends on the load, not on the length of stay distribution
+    '''
+    stays = [config.non_stroke_duration, config.ischemic_rate, config.hemorrhagic_rate]
+    load = 0.0
+    for hospital in config.hospitals:
+        stroke = hospital.arrival_rate_stroke
+        rates = [hospital.arrival_rate_non_stroke,
+                 stroke * (1 - HEMORRHAGIC_PERCENTAGE),
+                 stroke * HEMORRHAGIC_PERCENTAGE]
+        if hospital.kind == 'PSC':
+            rates = [rate * keep for rate, keep in zip(rates, [1.0, hospital.transfer_rate, 1.0])]
+        load += sum(rate * stay for rate, stay in zip(rates, stays))
+    return load
+
+
+# Outcome of plan_capacity, estimates maps every simulated bed count to the Estimate of its blocking percentage
+CapacityPlan = namedtuple('CapacityPlan', ['beds', 'analytic_beds', 'load', 'estimates'])
+
+
+def plan_capacity(config, target_blocking, confidence = 0.95, max_replications = 200,
+                  workers = None, seed = None, cache = None):
+    '''
+    Fewest CSC beds that keep the blocking probability (a fraction, e.g. 0.05) at or below target
+
+    The Erlang-B loss model gives the answer for the offered load first, then the bed counts
+    around it are simulated (run_until_precision, half width a tenth of the target)
+    until the smallest one whose whole confidence interval is at or below the target is found
+    Only for a star network with a single CSC: the offered load is that of the whole network
+    and every CSC would be given the same number of beds
+    Raises ValueError unless 0 < target_blocking < 1, or for any other network
+    '''
+    if not 0 < target_blocking < 1:
+        raise ValueError("target_blocking is a fraction between 0 and 1 (exclusive), got {}".format(target_blocking))
+    if len([hospital for hospital in config.hospitals if hospital.kind == 'CSC']) != 1:
+        raise ValueError("plan_capacity needs a star network with a single CSC")
+    load = config_offered_load(config)
+    upper = max(1, int(np.ceil(load)))
+    while erlang_b(upper, load) > target_blocking:
+        upper *= 2
+    analytic_beds = int(np.argmax(erlang_b(np.arange(upper + 1), load) <= target_blocking))
+
+    target = 100 * target_blocking
+    column = STATISTIC_NAMES.index("Overall Blocking Probability")
+    estimates = {}
+
+    def enough(beds):
+        if beds not in estimates:
+            result = run_until_precision(sweep_config(config, 'max_beds', beds), target / 10,
+                                         confidence = confidence, max_replications = max_replications,
+                                         workers = workers, seed = seed, cache = cache)
+            estimates[beds] = result.estimates[column]
+        return estimates[beds].mean + estimates[beds].half_width <= target
+
+    beds = analytic_beds
+    while not enough(beds):
+        beds += 1
+    while beds > 0 and enough(beds - 1):
+        beds -= 1
+
+    return CapacityPlan(beds, analytic_beds, load, estimates)
+
+
+def read_config(filename):
+    '''
+    Parse a config CSV (see instructions.md) into a Config, see scenarios.load_config
+    '''
+    return load_config(filename)
+
+
+if __name__ == "__main__":
+
+    print("Reading the Config File...")
+    config = read_config('hospitals_demo.csv')
+    apply_config(config)
+    print("     -> Finished Reading the Config File!\n")
+
+    many_times = False
+    save_output = True
+    workers = os.cpu_count()
+    seed = None
+    target_half_width = None # e.g. 0.2 to run until blocking is known to +- 0.2 percentage points
+    warmup = False # detect the warm-up and leave it out of the statistics
+    batch_means = False # one long run split into batches instead of separate replications
+    timeline = False # also plot the p5 / p50 / p95 occupancy of the CSC over time
+    scenario_path = None # a config file or directory of scenarios to run one after the other, e.g. 'scenarios/'
+    # reuse replications from earlier runs with the same parameters (needs a fixed seed)
+    cache = ResultCache() if seed is not None else None
+
+    if scenario_path is not None:
+        for scenario in load_scenarios(scenario_path):
+            print("############# SCENARIO {} ({}) #############".format(scenario.name, scenario.source))
+            apply_config(scenario.config)
+            list_of_metrics = run_replications(scenario.config, scenario.config.number_of_simulations,
+                                               workers = workers, seed = seed, warmup = warmup, cache = cache)
+            print_estimates(statistic_estimates(list_of_metrics))
+
+    elif many_times:
+        sweep_points = []
+        for point in sweep(config, "transfer_rate", [x / 100 for x in range(0, 101)], workers = workers, seed = seed,
+                           common_random_numbers = True, cache = cache):
+            print("############# TRANSFER RATE = {} #############".format(point.value))
+            combine_metrics(point.metrics)
+            sweep_points.append(point)
+
+        for difference in paired_differences(sweep_points):
+            print("{0:.2f} -> {1:.2f}: blocking {2:+.3f}% +- {3:.3f}".format(
+                difference.from_value, difference.to_value, difference.estimate.mean, difference.estimate.half_width))
+
+        values, blocking_probabilities = blocking_curve(sweep_points)
+        plot_blocking_curve(values, blocking_probabilities, "large_simulation_output.png")
+
+    elif batch_means:
+        print("Running one long simulation for batch means...")
+        result = run_batch_means(config, seed = seed)
+        print("     -> Finished the simulation! {} batches of {} days after a {} day warm-up\n".format(
+            len(result.metrics), result.batch_size * WARMUP_INTERVAL, result.warmup_time))
+
+        combine_metrics(result.metrics, plot = True, toCSV = save_output)
+        print_estimates(result.estimates)
+
+    elif target_half_width is not None:
+        print("Running simulations until blocking is within +- {} on {} workers...".format(target_half_width, workers))
+        result = run_until_precision(config, target_half_width, workers = workers, seed = seed, cache = cache)
+        if not result.converged:
+            print("     -> Replication budget used up before reaching the target")
+        print("     -> Finished the simulations!\n")
+
+        combine_metrics(result.metrics, plot = True, toCSV = save_output)
+        print_estimates(result.estimates)
+
+    else:
+        print("Running {} simulations on {} workers...".format(NUMBER_OF_SIMULATIONS, workers))
+        list_of_metrics = run_replications(config, NUMBER_OF_SIMULATIONS, workers = workers, seed = seed, warmup = warmup,
+                                           cache = cache)
+        print("     -> Finished the simulations!\n")
+
+        combine_metrics(list_of_metrics, plot = True, toCSV = save_output)
+        if timeline:
+            plot_occupancy_bands(occupancy_bands(config, NUMBER_OF_SIMULATIONS, workers = workers, seed = seed))
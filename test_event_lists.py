@@ -0,0 +1,45 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import simul2
+from event_lists import EVENT_LISTS, HeapEventList
+from test_simul2 import short_config, simulation
+
+
+@pytest.mark.parametrize('name', ['calendar', 'merge'])
+@pytest.mark.parametrize('seed', range(5))
+def test_events_come_off_in_heap_order(name, seed):
+    rng = np.random.default_rng(seed)
+    sequence = itertools.count()
+    reference = HeapEventList()
+    events = EVENT_LISTS[name]()
+    now = 0.0
+    # bursts of pushes and pops, so the calendar grows and shrinks, with far off events and ties in time
+    for burst in range(40):
+        for i in range(int(rng.integers(0, 200))):
+            gap = rng.choice([0.0, rng.exponential(0.1), rng.exponential(50.0)])
+            event = (now + gap, next(sequence), int(rng.integers(0, 3)), int(rng.integers(0, 4)), i)
+            reference.push(event)
+            events.push(event)
+        for i in range(min(len(reference), int(rng.integers(0, 200)))):
+            event = reference.pop()
+            assert events.pop() == event
+            now = event[0]
+        assert len(events) == len(reference)
+        assert events.peek() == reference.peek()
+    while reference:
+        assert events.pop() == reference.pop()
+    assert len(events) == 0
+
+
+@pytest.mark.parametrize('name', ['calendar', 'merge'])
+def test_backends_run_the_same_simulation(name):
+    config = short_config()
+    metrics = []
+    for event_list in ['heap', name]:
+        run = simulation(config, 2, event_list)
+        run.run_simulation()
+        metrics.append((run.events_processed, simul2.replication_metrics(run)))
+    assert metrics[0] == metrics[1]
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from scenarios import ConfigError, load_config
+
+
+DEMO = open(os.path.join(os.path.dirname(__file__), 'hospitals_demo.csv'), encoding = 'utf-8-sig').read()
+
+
+def write_config(tmp_path, text):
+    path = tmp_path / 'scenario.csv'
+    path.write_text(text, encoding = 'utf-8')
+    return str(path)
+
+
+def test_demo_loads(tmp_path):
+    config = load_config(write_config(tmp_path, DEMO))
+    assert config.duration == 2000
+    assert config.number_of_simulations == 10
+    assert [hospital.kind for hospital in config.hospitals] == ['CSC', 'PSC']
+
+
+def test_infinite_arrival_rate_is_rejected(tmp_path):
+    path = write_config(tmp_path, DEMO.replace(",Lake Forest,0.2,1.8,", ",Lake Forest,0.2,inf,"))
+    with pytest.raises(ConfigError, match = r"scenario\.csv:14: .*finite"):
+        load_config(path)
+
+
+def test_zero_duration_is_rejected(tmp_path):
+    path = write_config(tmp_path, DEMO.replace("Duration of Simulation,2000", "Duration of Simulation,0"))
+    with pytest.raises(ConfigError, match = r"scenario\.csv:6: Duration of Simulation = 0.0 is out of range \(0"):
+        load_config(path)
+
+
+def test_zero_simulations_are_rejected(tmp_path):
+    path = write_config(tmp_path, DEMO.replace("Number of Simulations,10", "Number of Simulations,0"))
+    with pytest.raises(ConfigError, match = r"scenario\.csv:7: Number of Simulations"):
+        load_config(path)
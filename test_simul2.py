@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+
+import simul2
+
+
+DEMO = os.path.join(os.path.dirname(__file__), 'hospitals_demo.csv')
+
+
+def short_config(duration = 200):
+    return simul2.read_config(DEMO)._replace(duration = duration)
+
+
+def test_results_do_not_depend_on_the_number_of_workers():
+    config = short_config()
+    serial = simul2.run_replications(config, 4, workers = 1, seed = 3)
+    parallel = simul2.run_replications(config, 4, workers = 3, seed = 3)
+    assert serial == parallel
+    assert serial[0] != serial[1]
+
+
+def simulation(config, seed, event_list = 'heap'):
+    simul2.apply_config(config)
+    hospital_dict = simul2.build_hospital_dict(simul2.build_hospitals(config.hospitals))
+    return simul2.Simulation(0, hospital_dict, rng = np.random.default_rng(seed), event_list = event_list)
+
+
+def test_restored_checkpoint_finishes_like_an_uninterrupted_run(tmp_path):
+    config = short_config()
+    whole = simulation(config, 5)
+    whole.run_simulation()
+
+    path = str(tmp_path / 'checkpoint.npz')
+    halfway = simulation(config, 5)
+    halfway.duration = config.duration / 2
+    halfway.advance()
+    assert 0 < halfway.events_processed < whole.events_processed
+    halfway.checkpoint(path)
+    restored = simul2.Simulation.restore(path)
+    restored.duration = config.duration
+    restored.run_simulation()
+
+    assert restored.events_processed == whole.events_processed
+    assert simul2.replication_metrics(restored) == simul2.replication_metrics(whole)
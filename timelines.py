@@ -0,0 +1,173 @@
+from array import array
+
+import numpy as np
+
+from trace_recorder import DISCHARGE
+
+
+TIMELINE_INTERVAL = 1.0 # days per point of a fixed interval timeline
+GRAPH_POINTS = 2000 # most points a plotted timeline is downsampled to
+BAND_PERCENTILES = (5, 50, 95)
+
+
+def interval_edges(duration, interval = None, start = 0.0):
+    '''
+    Edges of the fixed intervals covering [start, duration], the last one may be shorter
+    '''
+    interval = interval or TIMELINE_INTERVAL
+    edges = np.arange(start, duration, interval, dtype = float)
+    return np.append(edges, duration)
+
+
+def occupancy_area(times, counts, at, start_count = 0):
+    '''
+    Area under an occupancy step function up to each time in at (from time 0)
+    The count is start_count until times[0], then counts[i] from times[i] on
+    '''
+    times = np.concatenate([[0.0], np.asarray(times, dtype = float)])
+    counts = np.concatenate([[start_count], np.asarray(counts, dtype = float)])
+    area = np.concatenate([[0.0], np.cumsum(counts[:-1] * np.diff(times))])
+    i = np.searchsorted(times, at, side = 'right') - 1
+    return area[i] + counts[i] * (np.asarray(at, dtype = float) - times[i])
+
+
+def interval_means(times, counts, edges, start_count = 0):
+    '''
+    Time weighted mean occupancy over every interval between consecutive edges,
+    worked out from the (sorted) change times in one go
+    '''
+    return np.diff(occupancy_area(times, counts, edges, start_count)) / np.diff(edges)
+
+
+def sample(times, counts, at, start_count = 0):
+    '''
+    Occupancy at each time in at (the count after the last change at or before it)
+    '''
+    counts = np.concatenate([[start_count], np.asarray(counts)])
+    return counts[np.searchsorted(times, at, side = 'right')]
+
+
+def lttb(x, y, threshold = None):
+    '''
+    Largest-Triangle-Three-Buckets downsampling of a series to threshold points
+    The first and last points are kept, and from every bucket in between the point
+    that makes the largest triangle with the point kept before it and the mean of the next bucket
+    Returns (x, y) arrays, the series itself when it is short enough already
+    '''
+    threshold = threshold or GRAPH_POINTS
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    bounds = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype = int)
+    keep[0] = 0
+    keep[-1] = n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = bounds[bucket], bounds[bucket + 1]
+        following = slice(end, bounds[bucket + 2] if bucket + 2 < len(bounds) else n)
+        mean_x = x[following].mean()
+        mean_y = y[following].mean()
+        areas = np.abs((x[previous] - mean_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (mean_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        keep[bucket + 1] = previous
+    return x[keep], y[keep]
+
+
+def step_points(times, counts, end_time, start_count = 0):
+    '''
+    The corners of an occupancy step function up to end_time, as (x, y) arrays
+    (each count is repeated at the time of the next change), ready for lttb
+    '''
+    times = np.concatenate([[0.0], np.asarray(times, dtype = float), [end_time]])
+    counts = np.concatenate([[start_count], np.asarray(counts, dtype = float)])
+    x = np.repeat(times, 2)[1:-1]
+    y = np.repeat(counts, 2)
+    return x, y
+
+
+def percentile_bands(series, percentiles = None):
+    '''
+    Percentiles across replications of equally spaced series (one row per replication),
+    one row per percentile (p5 / p50 / p95 by default)
+    '''
+    return np.percentile(np.asarray(series, dtype = float), percentiles or BAND_PERCENTILES, axis = 0)
+
+
+class TimelineRecorder:
+    '''
+    Streams the occupancy of every hospital into fixed intervals during the run, so
+    the memory only depends on the number of intervals, not on the number of events
+    Takes the place of a TraceRecorder (Simulation(recorder = ...)): each interval keeps
+    the area under the bed count and the highest bed count reached in it
+    '''
+    def __init__(self, duration, interval = None):
+        self.interval = interval or TIMELINE_INTERVAL
+        self.duration = duration
+        self.bins = max(1, int(np.ceil(duration / self.interval)))
+        self.areas = []
+        self.peaks = []
+        self.last_time = []
+        self.count = []
+
+    def grow(self, hospitals):
+        while len(self.areas) < hospitals:
+            self.areas.append(array('d', bytes(8 * self.bins)))
+            self.peaks.append(array('i', bytes(4 * self.bins)))
+            self.last_time.append(0.0)
+            self.count.append(0)
+
+    def advance(self, hospital, time):
+        '''
+        Add the current bed count of a hospital to every interval up to time
+        '''
+        areas = self.areas[hospital]
+        peaks = self.peaks[hospital]
+        count = self.count[hospital]
+        last = self.last_time[hospital]
+        interval = self.interval
+        b = min(int(last / interval), self.bins - 1)
+        while True:
+            if count > peaks[b]:
+                peaks[b] = count
+            edge = (b + 1) * interval
+            if time <= edge or b == self.bins - 1:
+                areas[b] += count * (time - last)
+                break
+            areas[b] += count * (edge - last)
+            last = edge
+            b += 1
+        self.last_time[hospital] = time
+
+    def record(self, time, hospital, event, patient_class, bed_count):
+        if event > DISCHARGE:
+            return # rejections do not change the bed count
+        if hospital >= len(self.areas):
+            self.grow(hospital + 1)
+        self.advance(hospital, time)
+        self.count[hospital] = bed_count
+        b = min(int(time / self.interval), self.bins - 1)
+        if bed_count > self.peaks[hospital][b]:
+            self.peaks[hospital][b] = bed_count
+
+    def timeline(self, hospital, end_time = None):
+        '''
+        (edges, mean bed count, highest bed count) of every interval of a hospital up to end_time
+        (the duration by default)
+        '''
+        end_time = self.duration if end_time is None else end_time
+        if hospital >= len(self.areas):
+            self.grow(hospital + 1)
+        self.advance(hospital, end_time)
+        edges = interval_edges(end_time, self.interval)
+        bins = len(edges) - 1
+        means = np.frombuffer(self.areas[hospital], dtype = float)[:bins] / np.diff(edges)
+        peaks = np.frombuffer(self.peaks[hospital], dtype = np.int32)[:bins].copy()
+        return edges, means, peaks
+
+    def close(self):
+        pass
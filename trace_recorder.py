@@ -0,0 +1,154 @@
+import json
+import os
+from array import array
+
+import numpy as np
+
+
+# What happened to the patient, the event column of a trace
+ADMISSION = 0
+DISCHARGE = 1
+REJECTION = 2
+OVERFLOW = 3 # rejected, and sent on to the overflow CSC
+TRACE_EVENT_NAMES = ["Admission", "Discharge", "Rejection", "Overflow"]
+
+# (column, array typecode, numpy dtype)
+# patient_class holds the patient flags (STROKE_FLAG | TRANSFER_NEEDED_FLAG | FROM_PSC_FLAG in simul2)
+TRACE_COLUMNS = [
+    ('time', 'd', 'float64'),
+    ('hospital', 'i', 'int32'),
+    ('event', 'b', 'int8'),
+    ('patient_class', 'b', 'int8'),
+    ('bed_count', 'i', 'int32'),
+]
+
+TRACE_CHUNK_SIZE = 1 << 20 # rows per chunk file
+TRACE_FORMATS = ['npy', 'parquet']
+
+
+class TraceRecorder:
+    '''
+    Streams every change of state of the hospitals to chunked columnar files in a directory
+    Rows are buffered in memory and written out every chunk_size rows, either as one .npy file
+    per column per chunk (format 'npy', can be memory mapped) or one Parquet file per chunk
+    (format 'parquet', needs pyarrow). close() writes the trace.json that TraceReader starts from
+    '''
+    def __init__(self, directory, chunk_size = None, format = 'npy'):
+        if format not in TRACE_FORMATS:
+            raise ValueError("Unknown trace format {}, use one of {}".format(format, TRACE_FORMATS))
+        if format == 'parquet':
+            import pyarrow # raises ImportError here rather than at the first flush
+        self.directory = directory
+        self.chunk_size = chunk_size or TRACE_CHUNK_SIZE
+        self.format = format
+        self.chunk_lengths = []
+        self.columns = [array(typecode) for name, typecode, dtype in TRACE_COLUMNS]
+        os.makedirs(directory, exist_ok = True)
+
+    def record(self, time, hospital, event, patient_class, bed_count):
+        time_column, hospital_column, event_column, class_column, bed_column = self.columns
+        time_column.append(time)
+        hospital_column.append(hospital)
+        event_column.append(event)
+        class_column.append(patient_class)
+        bed_column.append(bed_count)
+        if len(time_column) >= self.chunk_size:
+            self.flush()
+
+    def chunk_path(self, chunk, column = None):
+        if column is None:
+            return os.path.join(self.directory, "chunk{:05d}.parquet".format(chunk))
+        return os.path.join(self.directory, "{}.{:05d}.npy".format(column, chunk))
+
+    def flush(self):
+        '''
+        Write the buffered rows out as the next chunk
+        '''
+        length = len(self.columns[0])
+        if length == 0:
+            return
+        chunk = len(self.chunk_lengths)
+        arrays = [np.frombuffer(column, dtype = dtype) for column, (name, typecode, dtype) in zip(self.columns, TRACE_COLUMNS)]
+
+        if self.format == 'npy':
+            for values, (name, typecode, dtype) in zip(arrays, TRACE_COLUMNS):
+                np.save(self.chunk_path(chunk, name), values)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            table = pyarrow.table({name: values for values, (name, typecode, dtype) in zip(arrays, TRACE_COLUMNS)})
+            pyarrow.parquet.write_table(table, self.chunk_path(chunk))
+
+        self.chunk_lengths.append(length)
+        self.columns = [array(typecode) for name, typecode, dtype in TRACE_COLUMNS]
+
+    def close(self):
+        self.flush()
+        meta = {
+            'format': self.format,
+            'columns': [[name, dtype] for name, typecode, dtype in TRACE_COLUMNS],
+            'chunk_lengths': self.chunk_lengths,
+        }
+        with open(os.path.join(self.directory, 'trace.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class TraceReader:
+    '''
+    Read back a trace written by TraceRecorder a chunk at a time, without loading all of it
+    .npy chunks are memory mapped, Parquet chunks are read through a memory map
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'trace.json')) as meta_file:
+            meta = json.load(meta_file)
+        self.format = meta['format']
+        self.column_names = [name for name, dtype in meta['columns']]
+        self.chunk_lengths = meta['chunk_lengths']
+
+    def __len__(self):
+        return sum(self.chunk_lengths)
+
+    def chunk(self, index, columns = None):
+        '''
+        One chunk as a dict of column name to array
+        '''
+        columns = columns or self.column_names
+        if self.format == 'npy':
+            return {name: np.load(os.path.join(self.directory, "{}.{:05d}.npy".format(name, index)), mmap_mode = 'r')
+                    for name in columns}
+
+        import pyarrow.parquet
+        path = os.path.join(self.directory, "chunk{:05d}.parquet".format(index))
+        table = pyarrow.parquet.read_table(path, columns = columns, memory_map = True)
+        return {name: table.column(name).to_numpy() for name in columns}
+
+    def chunks(self, columns = None):
+        for index in range(len(self.chunk_lengths)):
+            yield self.chunk(index, columns)
+
+    def column(self, name):
+        '''
+        A whole column in memory
+        '''
+        return np.concatenate([chunk[name] for chunk in self.chunks([name])] or [np.array([])])
+
+    def hospital_occupancy(self, hospital):
+        '''
+        (times, bed counts) after every admission and discharge at one hospital
+        '''
+        times = []
+        bed_counts = []
+        for chunk in self.chunks(['time', 'hospital', 'event', 'bed_count']):
+            keep = (chunk['hospital'] == hospital) & (chunk['event'] <= DISCHARGE)
+            times.append(np.asarray(chunk['time'][keep]))
+            bed_counts.append(np.asarray(chunk['bed_count'][keep]))
+        if not times:
+            return np.array([]), np.array([], dtype = np.int32)
+        return np.concatenate(times), np.concatenate(bed_counts)